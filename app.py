@@ -1,22 +1,50 @@
 import logbot
-import json, os, config
+import os, config
+import orjson
+import requests
 from flask import Flask, request, jsonify
 from orderapi import order
-from supabase import create_client, Client
-from v2_handler import tv_webhook_v2
-from worker import worker_bp, _try_run_daily_report_once_per_day
+from supabase import Client
+from v2_handler import tv_webhook_v2, MAX_WEBHOOK_BODY, _read_body_capped
+from worker import worker_bp, ENABLE_DAILY_REPORT, _try_run_daily_report_once_per_day
 from datetime import datetime, timezone
-import requests
+from config import _secret_ok
+from concurrent.futures import ThreadPoolExecutor
 
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_API_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase: Client = config.get_supabase()
 WORKER_SECRET = os.getenv("WORKER_SECRET", "defaultsecret")
+_WEBHOOK_PASSPHRASE_B = (os.environ.get('WEBHOOK_PASSPHRASE', config.WEBHOOK_PASSPHRASE) or "").encode("utf-8")
+_WORKER_SECRET_B = WORKER_SECRET.encode("utf-8")
+_REQUIRED_FIELDS = frozenset(('ticker', 'action'))
+_VALID_ACTIONS = frozenset(('BUY', 'SELL'))
+_STUDY_STRIP = frozenset(('passphrase', 'chart_url'))
 
 app = Flask(__name__)
+# Only form/files parsing honors this under werkzeug 2.0; webhook bodies go through _read_body_capped
+app.config["MAX_CONTENT_LENGTH"] = MAX_WEBHOOK_BODY
 app.register_blueprint(worker_bp)
 
+
+def _read_webhook_json():
+    """
+    Read at most MAX_WEBHOOK_BODY bytes from the request stream and parse them.
+    Returns (data, None) on success or (None, response) on failure.
+    """
+    body = _read_body_capped()
+    if body is None:
+        logbot.error(">>> /!\\ Payload too large: %s bytes", request.content_length)
+        return None, ({"success": False, "message": "Payload too large"}, 413)
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        logbot.error(">>> /!\\ JSON decode error: %s", e)
+        return None, {"success": False, "message": "Invalid JSON format"}
+    if not isinstance(data, dict):
+        logbot.logs(">>> /!\\ JSON body is not an object", True)
+        return None, {"success": False, "message": "Invalid JSON format"}
+    return data, None
+
 def enqueue_to_supabase(data):
     try:
         response = supabase.table("webhook_queue").insert({
@@ -26,7 +54,7 @@ def enqueue_to_supabase(data):
         logbot.logs("✅ Alert queued to Supabase")
         return {"success": True, "message": "Order queued", "id": response.data[0]["id"]}
     except Exception as e:
-        logbot.logs(f">>> /!\\ Supabase insert error: {e}", True)
+        logbot.error(">>> /!\\ Supabase insert error: %s", e)
         return {"success": False, "message": "Supabase insert error"}
 
 @app.route("/")
@@ -38,16 +66,12 @@ def tradingview_webhook():
     logbot.logs("========= STRATEGY =========")
     
     # Step 1: 解析数据
-    try:
-        data = json.loads(request.data)
-    except Exception as e:
-        logbot.logs(f">>> /!\\ JSON decode error: {e}", True)
-        return {"success": False, "message": "Invalid JSON format"}
+    data, err = _read_webhook_json()
+    if err:
+        return err
 
     # Step 2: passphrase 验证
-    webhook_passphrase = os.environ.get('WEBHOOK_PASSPHRASE', config.WEBHOOK_PASSPHRASE)
-
-    if 'passphrase' not in data or data['passphrase'] != webhook_passphrase:
+    if not _secret_ok(data.get('passphrase'), _WEBHOOK_PASSPHRASE_B):
         logbot.logs(">>> /!\\ Invalid or missing passphrase", True)
         return {"success": False, "message": "Invalid passphrase"}
 
@@ -56,24 +80,19 @@ def tradingview_webhook():
         data['subaccount'] = 'default'
 
     # Step 4: 基础字段校验
-    required_fields = ['ticker', 'action']
-    missing = [f for f in required_fields if f not in data]
+    missing = sorted(_REQUIRED_FIELDS.difference(data))
     if missing:
-        logbot.logs(f">>> /!\\ Missing fields: {missing}", True)
+        logbot.error(">>> /!\\ Missing fields: %s", missing)
         return {"success": False, "message": f"Missing fields: {', '.join(missing)}"}
 
-    # Step 5: 校验 action
-    if data['action'].upper() not in ['BUY', 'SELL']:
-        logbot.logs(f">>> /!\\ Invalid action: {data['action']}", True)
+    # Step 5: 校验 action（只规范化一次，写回 data 供下游直接使用）
+    action = str(data['action']).upper()
+    if action not in _VALID_ACTIONS:
+        logbot.error(">>> /!\\ Invalid action: %s", data['action'])
         return {"success": False, "message": "Action must be BUY or SELL"}
+    data['action'] = action
 
-    # # Step 6: 下单
-    # orders = order(data)
-    # print("✅ Order response:", orders)
-    # logbot.logs(f"✅ Order response: {orders}")
-    # return orders
-
-    # # Step 6, 写进database
+    # Step 6: 写进database
     return enqueue_to_supabase(data)
 
 
@@ -81,58 +100,91 @@ def tradingview_webhook():
 def discord_study_tv():
     logbot.logs("========== STUDY ==========")
 
-    try:
-        data = json.loads(request.data)
-    except Exception as e:
-        logbot.logs(f">>> /!\\ JSON decode error: {e}", True)
-        return {"success": False, "message": "Invalid JSON format"}
-
-    webhook_passphrase = os.environ.get('WEBHOOK_PASSPHRASE', config.WEBHOOK_PASSPHRASE)
+    data, err = _read_webhook_json()
+    if err:
+        return err
 
-    if 'passphrase' not in data or data['passphrase'] != webhook_passphrase:
+    if not _secret_ok(data.get('passphrase'), _WEBHOOK_PASSPHRASE_B):
         logbot.logs(">>> /!\\ Invalid or missing passphrase", True)
         return {"success": False, "message": "Invalid passphrase"}
 
-    del data["passphrase"]
-    chart_url = data.pop("chart_url", None)
+    chart_url = data.get("chart_url")
+    payload = {k: v for k, v in data.items() if k not in _STUDY_STRIP}
     if not chart_url:
         logbot.logs(">>> /!\\ Key 'chart_url' not found", True)
 
-    logbot.study_alert(json.dumps(data), chart_url)
+    logbot.study_alert(orjson.dumps(payload).decode(), chart_url)
     return {"success": True}
 
 
+# Alpaca 按账户限流，并发上限保持较小
+_V1_WORKER_THREADS = 8
+
+
+def _execute_v1_rows(rows):
+    """Execute queued v1 orders in order; return (processed_ids, error_ids)."""
+    ok_ids = []
+    err_ids = []
+    for row in rows:
+        payload = row["data"]
+        if isinstance(payload, dict):
+            action_v1 = (payload.get("action") or "").upper()
+            if action_v1 == "SELL" and "percentage" in payload:
+                payload = dict(payload)
+                payload.pop("percentage", None)
+        logbot.info("[Worker] Executing order: %s", payload)
+        try:
+            result = order(payload)
+            if isinstance(result, dict) and result.get("success"):
+                ok_ids.append(row["id"])
+                logbot.logs("[Worker] ✅ Order placed")
+            else:
+                msg = (result or {}).get("message") if isinstance(result, dict) else None
+                logbot.error("[Worker] ❌ Order failed result; marking error. %s", msg)
+                err_ids.append(row["id"])
+        except Exception as e:
+            logbot.error("[Worker] ❌ Order error: %s", e)
+            err_ids.append(row["id"])
+    return ok_ids, err_ids
+
+
 @app.route("/run-worker", methods=["GET"])
 def run_worker():
     key = request.args.get("key")
-    if key != WORKER_SECRET:
+    if not _secret_ok(key, _WORKER_SECRET_B):
         return {"success": False, "message": "Unauthorized"}, 403
 
     try:
         result = supabase.table("webhook_queue").select("*").eq("status", "pending").execute()
+        processed_ids = []
+        error_ids = []
+        # 同一 (subaccount, ticker) 的订单保持原顺序串行执行，不同标的之间并发
+        groups = {}
         for row in result.data:
             payload = row["data"]
             if isinstance(payload, dict):
-                action_v1 = (payload.get("action") or "").upper()
-                if action_v1 == "SELL" and "percentage" in payload:
-                    payload = dict(payload)
-                    payload.pop("percentage", None)
-            logbot.logs(f"[Worker] Executing order: {payload}")
-            try:
-                result = order(payload)
-                supabase.table("webhook_queue").update({"status": "processed"}).eq("id", row["id"]).execute()
-                logbot.logs(f"[Worker] ✅ Order placed and marked processed")
-            except Exception as e:
-                logbot.logs(f"[Worker] ❌ Order error: {e}", True)
-                supabase.table("webhook_queue").update({"status": "error"}).eq("id", row["id"]).execute()
-        if os.getenv("ENABLE_DAILY_REPORT", "0").strip().lower() in ("1", "true", "yes"):
+                gkey = (payload.get("subaccount"), payload.get("ticker"))
+            else:
+                gkey = (None, row["id"])
+            groups.setdefault(gkey, []).append(row)
+        if groups:
+            with ThreadPoolExecutor(max_workers=min(_V1_WORKER_THREADS, len(groups))) as ex:
+                for ok_ids, err_ids in ex.map(_execute_v1_rows, groups.values()):
+                    processed_ids.extend(ok_ids)
+                    error_ids.extend(err_ids)
+        # 批量回写状态：每种状态一次请求，而不是每行一次
+        if processed_ids:
+            supabase.table("webhook_queue").update({"status": "processed"}).in_("id", processed_ids).execute()
+        if error_ids:
+            supabase.table("webhook_queue").update({"status": "error"}).in_("id", error_ids).execute()
+        if ENABLE_DAILY_REPORT:
             try:
                 _try_run_daily_report_once_per_day()
             except Exception as rpt_err:
-                logbot.logs(f"[Report] ❌ daily report via run-worker failed: {rpt_err}", True)
+                logbot.error("[Report] ❌ daily report via run-worker failed: %s", rpt_err)
         return {"success": True, "message": "Worker run complete"}
     except Exception as e:
-        logbot.logs(f"[Worker] ❌ Supabase poll error: {e}", True)
+        logbot.error("[Worker] ❌ Supabase poll error: %s", e)
         return {"success": False, "message": "Worker failed"}
 
 
@@ -143,40 +195,59 @@ if _path_token:
 else:
     v2_path = "/v2/tradingview-to-webhook-order"
 
-@app.route(v2_path, methods=["POST"])
-def v2_entry():
-    return tv_webhook_v2()
+app.add_url_rule(v2_path, endpoint="v2_entry", view_func=tv_webhook_v2, methods=["POST"])
 
 
-@app.route("/health", methods=["GET"])
-def health():
-    ts = datetime.now(tz=timezone.utc).isoformat()
-    missing = []
-    for k in [
-        "SUPABASE_URL",
-        "SUPABASE_API_KEY",
-        "WORKER_URL",
-        "WORKER_SECRET",
-        "ALPACA_API_KEY",
-        "ALPACA_SECRET_KEY",
-        "ALPACA_BASE_URL",
-    ]:
-        if not os.getenv(k):
-            missing.append(k)
+# /health 探测结果短时缓存，避免每次探针都同步等待 Supabase / Alpaca
+_health_cache = config.TTLCache(ttl_sec=15)
+_DB_PROBE_TTL = 5
+_ALPACA_PROBE_TTL = 15
+_ENV_PROBE_TTL = 30
+_HEALTH_REQUIRED_ENV = (
+    "SUPABASE_URL",
+    "SUPABASE_API_KEY",
+    "WORKER_URL",
+    "WORKER_SECRET",
+    "ALPACA_API_KEY",
+    "ALPACA_SECRET_KEY",
+    "ALPACA_BASE_URL",
+)
 
-    # db_ok and queue_ready_cnt
+
+def _probe_env_missing():
+    missing = _health_cache.get("env", _ENV_PROBE_TTL)
+    if missing is None:
+        missing = [k for k in _HEALTH_REQUIRED_ENV if not os.environ.get(k)]
+        _health_cache.set("env", missing)
+    return missing
+
+
+def _probe_db():
+    hit = _health_cache.get("db", _DB_PROBE_TTL)
+    if hit is not None:
+        return hit
     db_ok = False
     queue_ready_cnt = 0
     try:
-        # light query
-        supabase.table("order_queue").select("id").limit(1).execute()
+        # HEAD + count=exact：不回传行数据，一次请求同时验证连通性与准确计数
+        res = supabase.table("order_queue").select("id", count="exact", head=True).eq("status", "ready").execute()
         db_ok = True
-        res = supabase.table("order_queue").select("id").eq("status", "ready").limit(1000).execute()
-        queue_ready_cnt = len(res.data or [])
+        queue_ready_cnt = res.count or 0
     except Exception:
         db_ok = False
+    _health_cache.set("db", (db_ok, queue_ready_cnt))
+    return db_ok, queue_ready_cnt
 
-    # Alpaca ping (optional)
+
+# Health probe gets its own session: the shared config.http_session retries 502/503/504,
+# which would stretch the (0.5, 0.5) timeout to seconds. Plain adapters make no retries.
+_probe_session = requests.Session()
+
+
+def _probe_alpaca():
+    hit = _health_cache.get("alpaca", _ALPACA_PROBE_TTL)
+    if hit is not None:
+        return hit[0]
     alpaca_ping = None
     ak = os.getenv("ALPACA_API_KEY")
     sk = os.getenv("ALPACA_SECRET_KEY")
@@ -185,17 +256,31 @@ def health():
         base = base[:-3]
     if ak and sk and base:
         try:
-            r = requests.get(
+            r = _probe_session.get(
                 f"{base}/v2/account",
                 headers={
                     "APCA-API-KEY-ID": ak,
                     "APCA-API-SECRET-KEY": sk,
                 },
-                timeout=2,
+                timeout=(0.5, 0.5),
             )
             alpaca_ping = r.status_code
         except Exception:
             alpaca_ping = None
+    _health_cache.set("alpaca", (alpaca_ping,))
+    return alpaca_ping
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    ts = datetime.now(tz=timezone.utc).isoformat()
+    missing = _probe_env_missing()
+
+    # db_ok and queue_ready_cnt
+    db_ok, queue_ready_cnt = _probe_db()
+
+    # Alpaca ping (optional)
+    alpaca_ping = _probe_alpaca()
 
     return jsonify({
         "ts": ts,
@@ -1,5 +1,13 @@
 import os
+import hmac
+import time
+import threading
+import orjson
+from collections import OrderedDict
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timezone, date
 
 # Existing placeholders kept for backward compatibility
@@ -23,26 +31,95 @@ API_KEY_MYBYBITACCOUNT = None
 API_SECRET_MYBYBITACCOUNT = None
 
 
+# ===== Shared HTTP session (keep-alive pool for Alpaca / Discord) =====
+
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=(502, 503, 504)),
+))
+
+
+def tune_supabase_http(sb):
+    """
+    Opt-in (SUPABASE_HTTP2=1): swap the PostgREST httpx client for an HTTP/2 one
+    with a larger keep-alive pool and one transparent connect retry. Needs
+    `pip install httpx[http2]`; on any failure the SDK's default client is kept.
+    """
+    if not _parse_bool_env("SUPABASE_HTTP2", False):
+        return sb
+    try:
+        import httpx
+        pg = sb.postgrest
+        old = pg.session
+        pg.session = httpx.Client(
+            base_url=old.base_url,
+            headers=old.headers,
+            timeout=old.timeout,
+            transport=httpx.HTTPTransport(
+                http2=True,
+                retries=1,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0),
+            ),
+        )
+        old.close()
+    except Exception as e:
+        import logbot  # lazy: logbot imports config
+        logbot.info("[Config] SUPABASE_HTTP2 tuning failed, keeping default client: %s", e, log_to_discord=False)
+    return sb
+
+
+@lru_cache(maxsize=1)
+def get_supabase():
+    """
+    Process-wide Supabase client shared by app, v2 and worker (one PostgREST
+    connection pool). SUPABASE_TIMEOUT_SECONDS caps PostgREST call latency.
+    """
+    from supabase import create_client
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_API_KEY")
+    if not url or not key:
+        raise RuntimeError("SUPABASE_URL and SUPABASE_API_KEY must be set")
+    timeout = os.getenv("SUPABASE_TIMEOUT_SECONDS")
+    if timeout:
+        from supabase import ClientOptions
+        sb = create_client(url, key, options=ClientOptions(postgrest_client_timeout=float(timeout)))
+    else:
+        sb = create_client(url, key)
+    return tune_supabase_http(sb)
+
+
 # ===== Centralized config helpers for v2/worker risk guard =====
 
 def _env_first(*names):
-    for n in names:
-        v = os.getenv(n)
-        if v:
-            return v
-    return None
+    return next((v for n in names if (v := os.getenv(n))), None)
+
+
+_TRUE_TOKENS = frozenset(("1", "true", "yes", "y", "on"))
+_FALSE_TOKENS = frozenset(("0", "false", "no", "n", "off"))
 
 
 def _parse_bool_env(name: str, default: bool = None) -> bool | None:
     v = os.getenv(name)
     if v is None:
         return default
-    return v.strip().lower() in ("1", "true", "yes", "y", "on")
+    return v.strip().lower() in _TRUE_TOKENS
 
 
+def _secret_ok(supplied, expected: bytes) -> bool:
+    # hmac.compare_digest 为常量时间比较，避免通过响应时间泄露口令前缀
+    if not expected or not isinstance(supplied, str):
+        return False
+    return hmac.compare_digest(supplied.encode("utf-8"), expected)
+
+
+@lru_cache(maxsize=32)
 def resolve_alpaca_for_alias(alias: str):
     """
     Canonical resolver for Alpaca credentials and endpoint by alias.
+    Results are memoized per alias (env is static for the process lifetime);
+    call resolve_alpaca_for_alias.cache_clear() after changing env at runtime.
     Supports these envs (by precedence):
       - Key:   ALPACA_KEY_ID__alias, ALPACA_API_KEY__alias, ALPACA_KEY_ID, ALPACA_API_KEY, APCA_API_KEY_ID
       - Secret:ALPACA_SECRET_KEY__alias, ALPACA_API_SECRET__alias, ALPACA_SECRET_KEY, ALPACA_API_SECRET, APCA_API_SECRET_KEY
@@ -81,29 +158,69 @@ def resolve_alpaca_for_alias(alias: str):
     return key, sec, base, bool(paper)
 
 
+@lru_cache(maxsize=32)
+def alpaca_headers(alias: str) -> dict:
+    """Auth headers for raw Alpaca REST calls, built once per alias. Do not mutate."""
+    key, sec, _base, _paper = resolve_alpaca_for_alias(alias)
+    return {"APCA-API-KEY-ID": key, "APCA-API-SECRET-KEY": sec}
+
+
 def get_day_key_utc(dt: datetime | None = None) -> str:
     dt = dt or datetime.now(tz=timezone.utc)
     return dt.strftime("%Y-%m-%d")
 
 
-# Simple in-module equity cache: { alias: (ts_epoch, equity_float) }
-_equity_cache = {}
+class TTLCache:
+    """
+    Minimal thread-safe TTL cache keyed by any hashable.
+    Timestamps use time.monotonic() so wall-clock jumps don't expire/extend entries.
+    """
+
+    def __init__(self, ttl_sec: float, maxsize: int = 64):
+        self.ttl_sec = ttl_sec
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # oldest write first
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl_sec: float | None = None):
+        ttl = self.ttl_sec if ttl_sec is None else ttl_sec
+        hit = self._data.get(key)
+        if hit is not None and (time.monotonic() - hit[0]) < ttl:
+            return hit[1]
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            now = time.monotonic()
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                # purge expired entries from the old end, then drop the oldest live one
+                while self._data and now - next(iter(self._data.values()))[0] >= self.ttl_sec:
+                    self._data.popitem(last=False)
+                if len(self._data) >= self.maxsize:
+                    self._data.popitem(last=False)
+            self._data[key] = (now, value)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+# In-module equity cache: { alias: (ts_monotonic, equity_float) }
+_equity_cache = TTLCache(ttl_sec=60)
+# v2 webhook gate reads (account_state / strategies); writes below invalidate it
+gate_cache = TTLCache(ttl_sec=float(os.getenv("GATE_CACHE_TTL_SECONDS", "5")), maxsize=256)
 
 
 def get_equity_cached(alias: str, ttl_sec: int = 60) -> float:
-    import time
-    now = time.time()
-    ts, eq = _equity_cache.get(alias, (0, None))
-    if eq is not None and (now - ts) < ttl_sec:
+    eq = _equity_cache.get(alias, ttl_sec)
+    if eq is not None:
         return eq
-    key, sec, base, _paper = resolve_alpaca_for_alias(alias)
-    r = requests.get(f"{base}/v2/account", headers={
-        "APCA-API-KEY-ID": key,
-        "APCA-API-SECRET-KEY": sec,
-    }, timeout=5)
+    base = resolve_alpaca_for_alias(alias)[2]
+    r = http_session.get(f"{base}/v2/account", headers=alpaca_headers(alias), timeout=5)
     r.raise_for_status()
-    eq = float(r.json()["equity"])  # string numeric
-    _equity_cache[alias] = (now, eq)
+    eq = float(orjson.loads(r.content)["equity"])  # string numeric
+    _equity_cache.set(alias, eq)
     return eq
 
 
@@ -115,14 +232,50 @@ def load_account_state(sb) -> dict | None:
         return None
 
 
+def load_account_state_cached(sb) -> dict | None:
+    """load_account_state behind gate_cache; update_account_state invalidates it."""
+    st = gate_cache.get(("state",))
+    if st is None:
+        st = load_account_state(sb)
+        if st is not None:
+            gate_cache.set(("state",), st)
+    return st
+
+
 def update_account_state(sb, **fields) -> dict | None:
     try:
         res = sb.table("account_state").update(fields).eq("id", 1).execute()
+        gate_cache.pop(("acct",))
+        gate_cache.pop(("state",))
         return res.data[0] if res and res.data else None
     except Exception:
         return None
 
 
+def bump_high_watermark(sb, eq: float) -> dict | None:
+    """
+    Raise account_state.daily_high_watermark to eq only if it is higher (server-side
+    condition, so concurrent workers never lower it). The returned row re-seeds the
+    state cache, so the next risk check needs no read.
+    """
+    try:
+        res = (
+            sb.table("account_state")
+            .update({"daily_high_watermark": eq})
+            .eq("id", 1)
+            .or_(f"daily_high_watermark.is.null,daily_high_watermark.lt.{eq}")
+            .execute()
+        )
+        gate_cache.pop(("acct",))
+        gate_cache.pop(("state",))
+        row = res.data[0] if res and res.data else None
+        if row is not None:
+            gate_cache.set(("state",), row)
+        return row
+    except Exception:
+        return None
+
+
 def get_or_set_day_open_equity(sb, alias: str, now_utc) -> float | None:
     """
     Ensure daily_metrics row exists for (d, alias). Return stored 'equity' (may be None).
@@ -28,8 +28,9 @@ Daily Report → Discord Embed
   # SUPABASE_SERVICE_ROLE_KEY=
 """
 
-import os, sys, json, datetime, requests
+import os, sys, json, datetime
 from datetime import timezone
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 
 try:
@@ -58,11 +59,11 @@ def aliases_from_env() -> List[str]:
     return [a.strip() for a in raw.split(",") if a.strip()]
 
 
-from config import resolve_alpaca_for_alias
+from config import resolve_alpaca_for_alias, http_session
 
 def alpaca_get(base: str, key: str, sec: str, path: str, params=None, timeout=8) -> Any:
     url = f"{base}/v2{path if path.startswith('/') else '/'+path}"
-    r = requests.get(
+    r = http_session.get(
         url,
         headers={"APCA-API-KEY-ID": key, "APCA-API-SECRET-KEY": sec},
         params=params or {},
@@ -84,27 +85,31 @@ def fetch_account_snapshot(alias: str) -> Dict[str, Any]:
         "after": after_iso,
         "limit": 500
     })
-    filled = [o for o in orders if o.get("status") in ("filled", "partially_filled")]
-    canceled = [o for o in orders if o.get("status") == "canceled"]
-    rejected = [o for o in orders if o.get("status") == "rejected"]
-
-    # 简单的方向计数（可选）
-    def side_counts(dd: List[Dict[str, Any]]):
-        b = sum(1 for x in dd if (x.get("side") or "").lower() == "buy")
-        s = sum(1 for x in dd if (x.get("side") or "").lower() == "sell")
-        return b, s
-
-    b_f, s_f = side_counts(filled)
+    # 单次遍历完成状态分桶与成交方向计数
+    filled_count = canceled_count = rejected_count = b_f = s_f = 0
+    for o in orders:
+        st = o.get("status")
+        if st in ("filled", "partially_filled"):
+            filled_count += 1
+            side = (o.get("side") or "").lower()
+            if side == "buy":
+                b_f += 1
+            elif side == "sell":
+                s_f += 1
+        elif st == "canceled":
+            canceled_count += 1
+        elif st == "rejected":
+            rejected_count += 1
 
     return {
         "alias": alias,
         "equity": equity,
         "equity_change": equity - last_equity,
-        "filled_count": len(filled),
+        "filled_count": filled_count,
         "filled_buy": b_f,
         "filled_sell": s_f,
-        "canceled_count": len(canceled),
-        "rejected_count": len(rejected),
+        "canceled_count": canceled_count,
+        "rejected_count": rejected_count,
     }
 
 
@@ -117,14 +122,14 @@ def supabase_health() -> Dict[str, Any] | None:
     sb = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
     try:
         # ready 队列
-        ready = sb.table("order_queue").select("id", count="exact").eq("status","ready").execute().count or 0
+        ready = sb.table("order_queue").select("id", count="exact", head=True).eq("status","ready").execute().count or 0
         # 今天失败
-        failed_today = sb.table("order_queue").select("id", count="exact") \
+        failed_today = sb.table("order_queue").select("id", count="exact", head=True) \
             .eq("status","failed") \
             .gte("updated_at", start_of_utc_day(now_utc()).isoformat()) \
             .execute().count or 0
         # DLQ 总数
-        dlq = sb.table("order_queue_dlq").select("id", count="exact").execute().count or 0
+        dlq = sb.table("order_queue_dlq").select("id", count="exact", head=True).execute().count or 0
         return {"queue_ready": ready, "queue_failed_today": failed_today, "dlq_total": dlq}
     except Exception as e:
         return {"error": str(e)}
@@ -176,7 +181,7 @@ def post_discord(embed: Dict[str, Any]):
         print("No DISCORD_WEBHOOK_URL configured; skip posting.", file=sys.stderr)
         return
     payload = {"embeds": [embed]}
-    r = requests.post(url, json=payload, timeout=8)
+    r = http_session.post(url, json=payload, timeout=8)
     if r.status_code >= 300:
         raise RuntimeError(f"Discord webhook failed: {r.status_code} {r.text}")
 
@@ -187,13 +192,18 @@ def post_discord(embed: Dict[str, Any]):
 def main():
     rows = []
     errs = []
-    for alias in aliases_from_env():
-        try:
-            rows.append(fetch_account_snapshot(alias))
-        except Exception as e:
-            errs.append(f"[{alias}] {e}")
+    aliases = aliases_from_env()
+    # 各账户快照与 Supabase 健康度并发拉取（均为 I/O 等待），结果仍按别名顺序汇总
+    with ThreadPoolExecutor(max_workers=min(8, len(aliases) + 1)) as ex:
+        sbh_fut = ex.submit(supabase_health)
+        futs = [(alias, ex.submit(fetch_account_snapshot, alias)) for alias in aliases]
+        for alias, fut in futs:
+            try:
+                rows.append(fut.result())
+            except Exception as e:
+                errs.append(f"[{alias}] {e}")
+        sbh = sbh_fut.result()
 
-    sbh = supabase_health()
     embed = build_discord_embed(rows, sbh)
 
     # 同时打印到 stdout
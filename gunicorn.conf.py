@@ -0,0 +1,14 @@
+# Gunicorn config (auto-loaded by `gunicorn app:app` from the project root).
+# Webhook handlers mostly wait on Supabase / Alpaca / Discord I/O, so use
+# threaded workers: each process serves many in-flight requests concurrently.
+import os
+
+# Set GUNICORN_WORKER_CLASS=gevent (requires `pip install gevent`) to serve
+# in-flight requests from one event loop per process instead of threads;
+# gunicorn monkey-patches sockets, so the requests-based Alpaca SDK yields on I/O.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "30"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
@@ -1,4 +1,5 @@
-import requests, config, os
+import config, os, sys, atexit, queue, logging, logging.handlers
+from config import http_session
 
 DISCORD_LOGS_URL = os.environ.get('DISCORD_LOGS_URL', config.DISCORD_LOGS_URL)
 
@@ -11,6 +12,19 @@ DISCORD_STUDY_URL = os.environ.get('DISCORD_STUDY_URL', config.DISCORD_STUDY_URL
 DISCORD_STUDY_AVATAR_URL = os.environ.get('DISCORD_STUDY_AVATAR_URL', config.DISCORD_STUDY_AVATAR_URL)
 
 
+# 控制台日志：请求线程只入队，由后台 QueueListener 线程负责写 stdout
+_log_queue = queue.Queue(-1)
+_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_listener.start()
+atexit.register(_listener.stop)
+
+log = logging.getLogger("tvbot")
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_level = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO').upper())
+log.setLevel(_level if isinstance(_level, int) else logging.INFO)  # 非法 LOG_LEVEL 回退 INFO
+log.propagate = False
+
+
 logs_format = {
 	"username": "logs",
 	"avatar_url": DISCORD_AVATAR_URL,
@@ -24,21 +38,39 @@ study_format = {
 }
 
 def logs(message, error=False, log_to_discord=True):
-    print(message)
+    level = logging.ERROR if error else logging.INFO
+    if not log.isEnabledFor(level):
+        return
+    log.log(level, message)
     if log_to_discord:
         try:
-            json_logs = logs_format
-            json_logs['content'] = message
-            requests.post(DISCORD_LOGS_URL, json=json_logs)
+            # 每次新建 payload：共享的 logs_format 不能被并发线程改写
+            json_logs = {**logs_format, 'content': message}
+            http_session.post(DISCORD_LOGS_URL, json=json_logs)
             if error:
-                requests.post(DISCORD_ERR_URL, json=json_logs)
+                http_session.post(DISCORD_ERR_URL, json=json_logs)
         except:
             pass
 
+def enabled(level) -> bool:
+    """True if messages at `level` ("info"/"error"/logging int) would be emitted."""
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    return log.isEnabledFor(level)
+
+def info(message, *args, log_to_discord=True):
+    """Lazy %-style variant of logs(): args are only formatted when INFO is enabled."""
+    if log.isEnabledFor(logging.INFO):
+        logs(message % args if args else message, False, log_to_discord)
+
+def error(message, *args, log_to_discord=True):
+    """Lazy %-style variant of logs(..., error=True)."""
+    if log.isEnabledFor(logging.ERROR):
+        logs(message % args if args else message, True, log_to_discord)
+
 def study_alert(message, chart_url):
     try:
-        json_logs = study_format
-        json_logs['content'] = ">>> " + message + " \n\n" + chart_url
-        requests.post(DISCORD_STUDY_URL, json=json_logs)
+        json_logs = {**study_format, 'content': ">>> " + message + " \n\n" + chart_url}
+        http_session.post(DISCORD_STUDY_URL, json=json_logs)
     except:
         pass
@@ -1,4 +1,5 @@
-import os, logbot
+import os, re, inspect, logbot, threading, time, uuid
+from functools import lru_cache
 from decimal import Decimal
 from alpaca.trading.client import TradingClient
 from alpaca.trading.requests import (
@@ -12,22 +13,24 @@ from alpaca.trading.requests import (
 from alpaca.trading.enums import OrderSide, TimeInForce, OrderClass, QueryOrderStatus  # 新增 OrderClass
 from alpaca.data.historical import StockHistoricalDataClient, CryptoHistoricalDataClient
 from alpaca.data.requests import CryptoLatestQuoteRequest, StockLatestBarRequest
-from config import resolve_alpaca_for_alias
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.adapters import HTTPAdapter
+from config import resolve_alpaca_for_alias, TTLCache, _parse_bool_env
 
 # =========================
 # Helpers
 # =========================
-def _parse_bool_env(name: str, default: bool = True) -> bool:
-    v = os.getenv(name)
-    if v is None:
-        return default
-    return v.strip().lower() in ("1", "true", "yes", "y", "on")
-
+@lru_cache(maxsize=1024)
 def _is_crypto(raw: str) -> bool:
-    s = (raw or "").upper()
+    s = (raw or "").strip().upper()
     # 简单判断：含 "/" 或 以 USD/USDT 结尾（适配常见加密对写法）
     return ("/" in s) or s.endswith("USD") or s.endswith("USDT")
 
+_EXCHANGE_PREFIX_RE = re.compile(r"^(?:BINANCE|COINBASE|FTX):")
+# 一次扫描同时去掉交易所前缀与 / : 分隔符
+_TRADE_STRIP_RE = re.compile(r"^(?:BINANCE|COINBASE|FTX):|[/:]")
+
+@lru_cache(maxsize=1024)
 def _norm_trade_symbol(raw: str) -> str:
     """
     供 交易 / 持仓 使用的符号：
@@ -36,10 +39,12 @@ def _norm_trade_symbol(raw: str) -> str:
     """
     s = (raw or "").strip().upper()
     if _is_crypto(s):
-        s = s.replace("BINANCE:", "").replace("COINBASE:", "").replace("FTX:", "")
-        s = s.replace("USDT", "USD").replace("/", "").replace(":", "")
+        s = _TRADE_STRIP_RE.sub("", s)
+        if s.endswith("USDT"):
+            s = s[:-4] + "USD"
     return s
 
+@lru_cache(maxsize=1024)
 def _to_crypto_pair_for_data(symbol_raw: str) -> str:
     """
     数据端尽量使用带斜杠的 crypto 对（ETH/USD）。
@@ -49,21 +54,47 @@ def _to_crypto_pair_for_data(symbol_raw: str) -> str:
     s = (symbol_raw or "").strip().upper()
     if not _is_crypto(s):
         return s
+    s = _EXCHANGE_PREFIX_RE.sub("", s)
     if "/" in s:
         return s
     # ETHUSD / ETHUSDT -> ETH/USD
-    base = s.replace("USDT", "USD")
-    if base.endswith("USD") and len(base) > 3:
-        return f"{base[:-3]}/USD"
-    return s
+    if s.endswith("USDT"):
+        base = s[:-4]
+    elif s.endswith("USD"):
+        base = s[:-3]
+    else:
+        return s
+    return f"{base}/USD" if base else s
+
+@lru_cache(maxsize=4096)
+def _classify(raw: str):
+    """
+    每个原始 ticker 只解析一次：返回 (is_crypto, 交易/持仓符号, 行情数据符号)。
+    """
+    return _is_crypto(raw), _norm_trade_symbol(raw), _to_crypto_pair_for_data(raw)
+
+# 常用 Decimal 常量：避免每单重复解析字符串
+_D0 = Decimal("0")
+_D1 = Decimal("1")
+_CRYPTO_MICRO = 1_000_000  # 6 位小数
+_DEFAULT_BUFFER_RATIO = Decimal("0.05")
+_MAX_BUFFER_RATIO = Decimal("0.95")
+
+def _to_dec(x) -> Decimal:
+    # int / Decimal 直接构造，免去 str 往返解析；其余（float、str）仍经 str 保持原有精度语义
+    if isinstance(x, Decimal) or (isinstance(x, int) and not isinstance(x, bool)):
+        return Decimal(x)
+    return Decimal(str(x))
 
 def _clamp_crypto_qty(q: Decimal) -> str:
     """
     Alpaca crypto 支持小数数量；保留 6 位且避免 0。
+    按微单位整数向零截断（不会超出持仓/资金），再直接拼成定点字符串。
     """
-    if q <= Decimal("0"):
-        q = Decimal("0.000001")
-    return format(q.quantize(Decimal("0.000001")), "f")
+    micro = int(q * _CRYPTO_MICRO)
+    if micro <= 0:
+        micro = 1
+    return f"{micro // _CRYPTO_MICRO}.{micro % _CRYPTO_MICRO:06d}"
 
 def _to_tif_enum(tif: str) -> TimeInForce:
     try:
@@ -75,52 +106,176 @@ def _to_tif_enum(tif: str) -> TimeInForce:
 # Env resolution (multi-account)
 # =========================
 
-def _get_env_first(*names):
-    for n in names:
-        v = os.getenv(n)
-        if v is not None and v != "":
-            return v
-    return None
-
+@lru_cache(maxsize=32)
 def _resolve_alpaca_creds(alias: str):
     key, secret, _base, paper = resolve_alpaca_for_alias(alias)
     return key, secret, paper
 
-# Cache clients by alias
+# 全进程共享一个连接池：urllib3 按 host 分池，鉴权在 header 中，
+# 因此各 alias 的 trading/stock/crypto 客户端可复用同一批 TLS 连接
+_alpaca_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+
+def _pool_session(client):
+    """
+    alpaca-py 客户端内部使用 requests.Session；挂载共享连接池，
+    让并发线程（价格/cash/撤单）与不同 alias 复用 keep-alive TLS 连接而不是新建。
+    不在此处加 Retry：SDK 自带 429/504 重试，且 POST 下单不应被重放。
+    """
+    sess = getattr(client, "_session", None)
+    if sess is not None:
+        sess.mount("https://", _alpaca_adapter)
+    return client
+
+# Cache clients by alias（双重检查加锁，避免并发请求为同一 alias 重复建客户端）
 _clients = {}
+_clients_lock = threading.Lock()
 
 def _get_clients(alias: str):
     a = (alias or "default").strip().lower()
-    if a in _clients:
-        return _clients[a]
-    key, secret, paper = _resolve_alpaca_creds(a)
-    trading = TradingClient(key, secret, paper=paper)
-    stock = StockHistoricalDataClient(key, secret)
-    crypto = CryptoHistoricalDataClient(key, secret)
-    _clients[a] = (trading, stock, crypto)
-    return _clients[a]
+    hit = _clients.get(a)
+    if hit is not None:
+        return hit
+    with _clients_lock:
+        hit = _clients.get(a)
+        if hit is not None:
+            return hit
+        key, secret, paper = _resolve_alpaca_creds(a)
+        trading = _pool_session(TradingClient(key, secret, paper=paper))
+        stock = _pool_session(StockHistoricalDataClient(key, secret))
+        crypto = _pool_session(CryptoHistoricalDataClient(key, secret))
+        hit = _clients[a] = (trading, stock, crypto)
+    if _PREWARM:
+        _warmup_pool.submit(_warmup, a, hit)
+    return hit
+
+def _aliases_from_env():
+    """default + 所有以 ALPACA_KEY_ID__/ALPACA_API_KEY__ 声明的 alias。"""
+    aliases = {"default"}
+    for name in os.environ:
+        for prefix in ("ALPACA_KEY_ID__", "ALPACA_API_KEY__"):
+            if name.startswith(prefix) and len(name) > len(prefix):
+                aliases.add(name[len(prefix):].lower())
+    return sorted(aliases)
+
+# 后台预热：提前与 trading / data 两个域名建立 TLS 连接，首单不再承担握手延迟
+_PREWARM = _parse_bool_env("ALPACA_PREWARM", True)
+# 预热走独立的单线程池，不占用下单路径的 _io_pool
+_warmup_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="orderapi-warmup")
+
+def _warmup(alias: str, clients):
+    trading, stock, crypto = clients
+    for name, call in (
+        ("clock", lambda: trading.get_clock()),
+        ("stock", lambda: stock.get_stock_latest_bar(StockLatestBarRequest(symbol_or_symbols=["SPY"]))),
+        ("crypto", lambda: crypto.get_crypto_latest_quote(CryptoLatestQuoteRequest(symbol_or_symbols=["BTC/USD"]))),
+    ):
+        try:
+            call()
+        except Exception as e:
+            logbot.info("[Warmup] %s warmup failed for %s: %s", name, alias, e, log_to_discord=False)
+
+# =========================
+# Account / position (short TTL)
+# =========================
+# 同一账户短时间内的连续下单复用 account / position，减少 REST 往返；下单成功后即失效
+_ACCOUNT_TTL = float(os.getenv("ACCOUNT_TTL_SECONDS", "3"))
+_account_cache = TTLCache(ttl_sec=_ACCOUNT_TTL)
+_position_cache = TTLCache(ttl_sec=1.0, maxsize=256)
+# max_slots 用的持仓数（按 alias），下单后与 account 一起失效
+_open_slots_cache = TTLCache(ttl_sec=2.0)
+# 价格与 cash 两个独立 GET 并发执行
+_io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="orderapi-io")
+
+def _alias_key(alias: str) -> str:
+    return (alias or "default").strip().lower()
+
+# 同一 alias 并发未命中时只发一次 get_account，其余线程等待并复用结果
+_account_locks = {}
+_account_locks_lock = threading.Lock()
+
+def _get_account_cached(alias: str, trading_client: TradingClient):
+    k = _alias_key(alias)
+    account = _account_cache.get(k)
+    if account is not None:
+        return account
+    lock = _account_locks.get(k)
+    if lock is None:
+        with _account_locks_lock:
+            lock = _account_locks.setdefault(k, threading.Lock())
+    with lock:
+        account = _account_cache.get(k)
+        if account is None:
+            account = trading_client.get_account()
+            _account_cache.set(k, account)
+    return account
+
+def _get_cash_cached(alias: str, trading_client: TradingClient) -> Decimal:
+    return _to_dec(_get_account_cached(alias, trading_client).cash)
+
+def _get_position_cached(alias: str, trading_client: TradingClient, symbol_trade: str):
+    k = (_alias_key(alias), symbol_trade)
+    pos = _position_cache.get(k)
+    if pos is None:
+        pos = trading_client.get_open_position(symbol_trade)
+        _position_cache.set(k, pos)
+    return pos
+
+def _get_open_slots_cached(alias: str, trading_client: TradingClient) -> int:
+    k = _alias_key(alias)
+    n = _open_slots_cache.get(k)
+    if n is None:
+        n = sum(1 for p in trading_client.get_all_positions() if float(getattr(p, "qty", 0) or 0))
+        _open_slots_cache.set(k, n)
+    return n
+
+def _invalidate_account(alias: str, symbol_trade: str):
+    k = _alias_key(alias)
+    _account_cache.pop(k)
+    _open_slots_cache.pop(k)
+    _position_cache.pop((k, symbol_trade))
 
 # =========================
 # Market Data
 # =========================
+# 进程内短 TTL 价格缓存：连续 webhook 查询同一标的时不再重复请求行情
+_PRICE_TTL_CRYPTO = float(os.getenv("PRICE_TTL_CRYPTO_SECONDS", "2"))
+_PRICE_TTL_STOCK = float(os.getenv("PRICE_TTL_STOCK_SECONDS", "10"))
+_price_cache = TTLCache(ttl_sec=_PRICE_TTL_STOCK, maxsize=256)
+# 负缓存：无效标的 1s 内不再轮询 crypto + stock 两个端点
+_price_miss = TTLCache(ttl_sec=1.0, maxsize=256)
+
 def get_latest_price(symbol_raw: str, stock_client: StockHistoricalDataClient, crypto_client: CryptoHistoricalDataClient):
-    """
-    先尝试加密（用带斜杠的对），失败再回退股票。
-    """
-    # ---- Crypto ----
+    key = (symbol_raw or "").strip().upper()
+    ttl = _PRICE_TTL_CRYPTO if _classify(key)[0] else _PRICE_TTL_STOCK
+    price = _price_cache.get(key, ttl)
+    if price is not None:
+        return price
+    if _price_miss.get(key) is not None:
+        return None
+    if _PRICE_BATCH_WINDOW > 0:
+        price = _price_batcher.get(key, stock_client, crypto_client)
+    else:
+        price = _fetch_latest_price(symbol_raw, stock_client, crypto_client)
+    if price is None:
+        _price_miss.set(key, True)
+    else:
+        _price_cache.set(key, price)
+    return price
+
+def _crypto_price(symbol_raw: str, crypto_client: CryptoHistoricalDataClient):
     try:
-        sym_for_data = _to_crypto_pair_for_data(symbol_raw)
-        if _is_crypto(sym_for_data):
-            quote_map = crypto_client.get_crypto_latest_quote(
-                CryptoLatestQuoteRequest(symbol_or_symbols=[sym_for_data])
-            )
-            quote = quote_map[sym_for_data]
-            mid = (quote.bid_price + quote.ask_price) / 2
-            return float(mid)
+        sym_for_data = _classify(symbol_raw)[2]
+        quote_map = crypto_client.get_crypto_latest_quote(
+            CryptoLatestQuoteRequest(symbol_or_symbols=[sym_for_data])
+        )
+        quote = quote_map[sym_for_data]
+        mid = (quote.bid_price + quote.ask_price) / 2
+        return float(mid)
     except Exception as e:
-        logbot.logs(f"[Price] Crypto quote failed for {symbol_raw}: {e}", True)
+        logbot.error("[Price] Crypto quote failed for %s: %s", symbol_raw, e)
+        return None
 
-    # ---- Stock ----
+def _stock_price(symbol_raw: str, stock_client: StockHistoricalDataClient):
     try:
         request = StockLatestBarRequest(symbol_or_symbols=[symbol_raw])
         bar_map = stock_client.get_stock_latest_bar(request)
@@ -129,9 +284,365 @@ def get_latest_price(symbol_raw: str, stock_client: StockHistoricalDataClient, c
             return float(bar.close)
         raise KeyError(f"No latest bar for {symbol_raw}")
     except Exception as e2:
-        logbot.logs(f"[Price] Stock quote failed for {symbol_raw}: {e2}", True)
+        logbot.error("[Price] Stock quote failed for %s: %s", symbol_raw, e2)
+        return None
+
+def _crypto_only(symbol_raw: str) -> bool:
+    """明确的加密写法：带 / 或交易所前缀、USDT 结尾，不会是股票代码。"""
+    s = symbol_raw.strip().upper()
+    return "/" in s or ":" in s or s.endswith("USDT")
+
+def _fetch_latest_price(symbol_raw: str, stock_client: StockHistoricalDataClient, crypto_client: CryptoHistoricalDataClient):
+    """
+    股票类标的只查股票端；明确的加密写法（带 / 或交易所前缀、USDT 结尾）只查 crypto 端；
+    其余形似加密的（如 ETHUSD）先查 crypto，失败后才回退到 stock 端。
+    """
+    if not _classify(symbol_raw)[0]:
+        return _stock_price(symbol_raw, stock_client)
+    if _crypto_only(symbol_raw):
+        return _crypto_price(symbol_raw, crypto_client)
+    price = _crypto_price(symbol_raw, crypto_client)
+    if price is not None:
+        return price
+    return _stock_price(symbol_raw, stock_client)
+
+# 突发 webhook 合并：窗口期内同一组 data client 的查询合并为一次多标的请求
+# 默认关闭（0）：leader 每次都要等满窗口，单条信号会白白多出这段延迟
+_PRICE_BATCH_WINDOW = float(os.getenv("PRICE_BATCH_WINDOW_MS", "0")) / 1000.0
+
+class _PriceBatcher:
+    """
+    首个调用者成为 leader：等待一个窗口期收集同批标的，然后每个市场只发一次
+    多标的请求，把结果分发给各调用者的 Future。批量请求失败时逐个回退到
+    _fetch_latest_price，保证行为与单标的查询一致。
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def get(self, symbol: str, stock_client, crypto_client):
+        bkey = (id(stock_client), id(crypto_client))
+        with self._lock:
+            batch = self._batches.get(bkey)
+            leader = batch is None
+            if leader:
+                batch = self._batches[bkey] = {}
+            fut = batch.get(symbol)
+            if fut is None:
+                fut = batch[symbol] = Future()
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                self._batches.pop(bkey, None)
+            self._flush(batch, stock_client, crypto_client)
+        return fut.result()
+
+    def _flush(self, batch: dict, stock_client, crypto_client):
+        prices = {}
+        try:
+            prices = self._fetch_many(list(batch), stock_client, crypto_client)
+        except Exception as e:
+            logbot.error("[Price] batch lookup failed: %s", e)
+        finally:
+            for sym, fut in batch.items():
+                fut.set_result(prices.get(sym))
+
+    @staticmethod
+    def _fetch_many(symbols, stock_client, crypto_client) -> dict:
+        if len(symbols) == 1:
+            return {symbols[0]: _fetch_latest_price(symbols[0], stock_client, crypto_client)}
+        prices = {}
+        # ---- Crypto（一次多标的请求）----
+        pairs = {}
+        for sym in symbols:
+            is_crypto, _trade, pair = _classify(sym)
+            if is_crypto:
+                pairs.setdefault(pair, []).append(sym)
+        if pairs:
+            try:
+                quote_map = crypto_client.get_crypto_latest_quote(
+                    CryptoLatestQuoteRequest(symbol_or_symbols=list(pairs))
+                )
+                for pair, syms in pairs.items():
+                    quote = quote_map.get(pair)
+                    if quote is not None:
+                        mid = float((quote.bid_price + quote.ask_price) / 2)
+                        for sym in syms:
+                            prices[sym] = mid
+                    else:
+                        # 明确的加密写法没有报价就是未命中，不拿去查股票端
+                        for sym in syms:
+                            if _crypto_only(sym):
+                                prices[sym] = None
+            except Exception as e:
+                logbot.error("[Price] Batch crypto quote failed for %s: %s", list(pairs), e)
+        # ---- Stock（其余标的，一次多标的请求）----
+        rest = [sym for sym in symbols if sym not in prices]
+        if rest:
+            try:
+                bar_map = stock_client.get_stock_latest_bar(StockLatestBarRequest(symbol_or_symbols=rest))
+                for sym in rest:
+                    bar = bar_map.get(sym)
+                    if bar:
+                        prices[sym] = float(bar.close)
+            except Exception as e:
+                logbot.error("[Price] Batch stock quote failed for %s: %s", rest, e)
+        # 批量未命中的逐个回退，保持与单标的查询相同的 crypto→stock 语义
+        for sym in symbols:
+            if sym not in prices:
+                prices[sym] = _fetch_latest_price(sym, stock_client, crypto_client)
+        return prices
 
-    return None
+_price_batcher = _PriceBatcher(_PRICE_BATCH_WINDOW)
+
+# =========================
+# Action handlers
+# =========================
+def _do_buy(payload, symbol_raw, symbol_trade, subaccount, clients):
+    """
+    BUY 数量计算：qty 明确则优先，其次 percentage，再次 max_slots，最后默认 1。
+    返回 Decimal 数量；若需提前结束（如槽位已满、无行情）则返回响应 dict。
+    """
+    trading_client, stock_client, crypto_client = clients
+    qty_in = payload.get("qty", None)              # 显式数量优先
+    percentage = payload.get("percentage", None)   # 0.3 表示 30%
+    max_slots_raw = payload.get("max_slots", None)
+    buffer_ratio_raw = payload.get("buffer_ratio", None)
+
+    max_slots = None
+    if max_slots_raw is not None:
+        try:
+            max_slots_int = int(_to_dec(max_slots_raw))
+            if max_slots_int > 0:
+                max_slots = max_slots_int
+            else:
+                logbot.info("[Order] Ignoring non-positive max_slots=%s", max_slots_raw)
+        except Exception:
+            logbot.info("[Order] Invalid max_slots value: %s", max_slots_raw)
+
+    if qty_in is not None:
+        qty_dec = _to_dec(qty_in)
+    elif percentage:
+        fut_price = _io_pool.submit(get_latest_price, symbol_raw, stock_client, crypto_client)
+        fut_cash = _io_pool.submit(_get_cash_cached, subaccount, trading_client)
+        price = fut_price.result()
+        if not price:
+            logbot.error("🚫 Order failed (%s): No price data", symbol_trade)
+            return {"success": False, "message": f"❌ No price data for {symbol_trade}"}
+        buying_power = fut_cash.result()
+        qty_dec = (buying_power * _to_dec(percentage)) / _to_dec(price)
+    elif max_slots:
+        # ---- max_slots sizing ----
+        # account / 持仓数 / 价格三个独立 GET 并发发出
+        fut_slots = _io_pool.submit(_get_open_slots_cached, subaccount, trading_client)
+        fut_price = _io_pool.submit(get_latest_price, symbol_raw, stock_client, crypto_client)
+        account = _get_account_cached(subaccount, trading_client)
+        try:
+            equity = _to_dec(account.equity)
+        except Exception:
+            raise Exception("Failed to load account equity for max_slots sizing")
+
+        buffer_ratio = _DEFAULT_BUFFER_RATIO
+        if buffer_ratio_raw is not None:
+            try:
+                buffer_ratio = _to_dec(buffer_ratio_raw)
+            except Exception:
+                logbot.info("[Order] Invalid buffer_ratio value: %s, defaulting to 0.05", buffer_ratio_raw)
+        if buffer_ratio < _D0:
+            logbot.info("[Order] buffer_ratio < 0 (%s); clamping to 0", buffer_ratio)
+            buffer_ratio = _D0
+        if buffer_ratio >= _D1:
+            logbot.info("[Order] buffer_ratio >= 1 (%s); clamping to 0.95", buffer_ratio)
+            buffer_ratio = _MAX_BUFFER_RATIO
+
+        available_equity = equity * (_D1 - buffer_ratio)
+        if available_equity <= _D0:
+            raise Exception("Available equity is non-positive after buffer_ratio adjustment")
+
+        try:
+            open_slots = fut_slots.result()
+        except Exception as pos_err:
+            raise Exception(f"Failed to fetch open positions: {pos_err}")
+        if open_slots >= max_slots:
+            msg = (
+                f"Skipped BUY for {symbol_trade}: open positions {open_slots} "
+                f"already at/above max_slots {max_slots}"
+            )
+        else:
+            target_value = available_equity / _to_dec(max_slots)
+            price = fut_price.result()
+            if not price:
+                logbot.error("🚫 Order failed (%s): No price data", symbol_trade)
+                return {"success": False, "message": f"❌ No price data for {symbol_trade}"}
+            qty_dec = target_value / _to_dec(price)
+            if qty_dec <= _D0:
+                raise Exception("Calculated quantity is non-positive with max_slots sizing")
+            logbot.info(
+                "[Order] max_slots sizing -> equity %s buffer %s target_value %s qty %s",
+                equity, buffer_ratio, target_value, qty_dec,
+            )
+        if open_slots >= max_slots:
+            logbot.info("[Order] %s", msg)
+            return {"success": True, "message": msg}
+    else:
+        qty_dec = _D1
+    return qty_dec
+
+def _open_sell_ids(trading_client, symbol_trade: str) -> list:
+    """该标的未成交 SELL 方向挂单（通常为 bracket 子单）的 id；只读，失败返回空列表。"""
+    try:
+        od_filter = GetOrdersRequest(
+            status=QueryOrderStatus.OPEN,
+            symbols=[symbol_trade],
+            nested=True,
+        )
+        open_orders = trading_client.get_orders(filter=od_filter)
+        # side 为 str 枚举，str() 会得到 "OrderSide.SELL"，需取 .value 比较
+        return [
+            od.id for od in open_orders
+            if str(getattr(getattr(od, "side", ""), "value", getattr(od, "side", ""))).lower() == "sell"
+        ]
+    except Exception as e_can:
+        # 非关键路径，失败只记录日志
+        logbot.info("[Order] fetch open orders failed for %s: %s", symbol_trade, e_can)
+        return []
+
+
+def _cancel_open_sells(trading_client, symbol_trade: str, sell_ids: list):
+    """取消 SELL 方向挂单以避免冲突/过度对冲；只能在确认持仓之后调用（否则会撤掉持仓的止损）。"""
+    def _cancel(oid) -> bool:
+        try:
+            trading_client.cancel_order_by_id(oid)
+            return True
+        except Exception as ce:
+            logbot.info("[Order] cancel child sell order failed for %s: %s", symbol_trade, ce)
+            return False
+
+    # 多个子单并发撤销（单个时直接在当前线程执行）
+    if len(sell_ids) > 1:
+        canceled_cnt = sum(_io_pool.map(_cancel, sell_ids))
+    else:
+        canceled_cnt = sum(map(_cancel, sell_ids))
+    if canceled_cnt:
+        logbot.info("[Order] Canceled %s open SELL orders for %s before SELL", canceled_cnt, symbol_trade)
+
+
+def _do_sell(payload, symbol_raw, symbol_trade, subaccount, clients):
+    """
+    SELL 数量计算（仅平仓，不做空）：qty 明确则优先，其次按持仓 percentage，默认全平。
+    无持仓时返回失败响应 dict。
+    """
+    trading_client, _stock_client, _crypto_client = clients
+    qty_in = payload.get("qty", None)
+    percentage = payload.get("percentage", None)
+
+    # 查仓与查询挂单（只读）并发执行；撤单必须等确认有持仓之后，避免查仓失败时持仓失去止损
+    # （注意必须用规范化后的 symbol_trade，避免 ETH/USD 触发 404）
+    sells_fut = _io_pool.submit(_open_sell_ids, trading_client, symbol_trade)
+    try:
+        pos_qty = _to_dec(_get_position_cached(subaccount, trading_client, symbol_trade).qty)
+    except Exception as ge:
+        logbot.error("🚫 Order failed (%s): Not holding %s: %s", symbol_trade, symbol_trade, ge)
+        return {"success": False, "message": f"❌ Not holding {symbol_trade}: {ge}"}
+
+    if pos_qty <= _D0:
+        logbot.error("🚫 Order failed (%s): No open position for %s", symbol_trade, symbol_trade)
+        return {"success": False, "message": f"❌ No open position for {symbol_trade}"}
+
+    _cancel_open_sells(trading_client, symbol_trade, sells_fut.result())
+
+    if qty_in is not None:
+        qty_dec = _to_dec(qty_in)
+    elif percentage:
+        qty_dec = (pos_qty * _to_dec(percentage))
+    else:
+        qty_dec = pos_qty
+    return qty_dec
+
+
+# action -> (数量计算函数, 下单方向)
+_HANDLERS = {
+    "BUY": (_do_buy, OrderSide.BUY),
+    "SELL": (_do_sell, OrderSide.SELL),
+}
+
+# 可选：submit_order 放到后台线程池，调用方立即拿到 queued 结果（默认关闭，
+# 队列状态依赖同步结果的 worker 不应开启）
+_ORDER_ASYNC = _parse_bool_env("ORDER_ASYNC_SUBMIT", False)
+_ORDER_WORKERS = int(os.getenv("ORDER_WORKERS", "8"))
+_ORDER_QUEUE_MAX = 256
+_order_executor = (
+    ThreadPoolExecutor(max_workers=_ORDER_WORKERS, thread_name_prefix="orderapi-submit")
+    if _ORDER_ASYNC else None
+)
+# 运行中 + 排队中的订单上限；满了就退回同步下单（背压）
+_order_slots = threading.BoundedSemaphore(_ORDER_WORKERS + _ORDER_QUEUE_MAX)
+
+
+# 每个 alias 同时在途的 submit_order 上限（Alpaca 按账户限流）
+_ALIAS_SUBMIT_LIMIT = int(os.getenv("ORDER_SUBMIT_PER_ALIAS", "4"))
+_alias_sems = {}
+_alias_sems_lock = threading.Lock()
+
+def _alias_sem(alias: str):
+    k = _alias_key(alias)
+    sem = _alias_sems.get(k)
+    if sem is None:
+        with _alias_sems_lock:
+            sem = _alias_sems.setdefault(k, threading.BoundedSemaphore(_ALIAS_SUBMIT_LIMIT))
+    return sem
+
+
+def _submit(trading_client, order_request, subaccount, symbol_trade, kind, qty_str):
+    with _alias_sem(subaccount):
+        resp = trading_client.submit_order(order_request)
+    _invalidate_account(subaccount, symbol_trade)
+    logbot.info("✅ Submitted %s order: %s %s x %s", kind, resp.id, symbol_trade, qty_str)
+    return resp
+
+
+def _on_submitted(fut, correlation_id, symbol_trade):
+    _order_slots.release()
+    e = fut.exception()
+    if e is not None:
+        logbot.error("🚫 Queued order %s failed (%s): %s: %s", correlation_id, symbol_trade, type(e).__name__, e)
+
+
+# =========================
+# Order Builders
+# =========================
+def _supports_client_order_id() -> bool:
+    """导入时探测一次 SDK 的订单请求模型是否支持 client_order_id。"""
+    fields = getattr(MarketOrderRequest, "model_fields", None) or getattr(MarketOrderRequest, "__fields__", None)
+    if fields:
+        return "client_order_id" in fields
+    try:
+        params = inspect.signature(MarketOrderRequest).parameters
+    except (TypeError, ValueError):
+        return True
+    return "client_order_id" in params or any(
+        p.kind is inspect.Parameter.VAR_KEYWORD for p in params.values()
+    )
+
+_SUPPORTS_CLIENT_OID = _supports_client_order_id()
+if not _SUPPORTS_CLIENT_OID:
+    logbot.info("[Order] client_order_id not supported by SDK; orders are sent without it", log_to_discord=False)
+
+def _bracket_legs(tp, sl):
+    return dict(
+        order_class=OrderClass.BRACKET,
+        take_profit=TakeProfitRequest(limit_price=float(tp)),
+        stop_loss=StopLossRequest(stop_price=float(sl)),
+    )
+
+# order_type -> (请求类, 必填价格字段)
+_ORDER_TYPES = {
+    "market": (MarketOrderRequest, None),
+    "limit": (LimitOrderRequest, "limit_price"),
+    "stop": (StopOrderRequest, "stop_price"),
+}
 
 # =========================
 # Order Entry
@@ -145,10 +656,7 @@ def order(payload):
     if client_order_id_in:
         client_order_id_in = str(client_order_id_in)[:48]
 
-    percentage = payload.get("percentage", None)   # 0.3 表示 30%
     qty_in = payload.get("qty", None)              # 显式数量优先
-    max_slots_raw = payload.get("max_slots", None)
-    buffer_ratio_raw = payload.get("buffer_ratio", None)
     order_type = (payload.get("order_type", "market") or "").lower()
     tif = (payload.get("time_in_force", "gtc") or "gtc").lower()
 
@@ -163,283 +671,86 @@ def order(payload):
     limit_price = payload.get("limit_price", None)
     stop_price = payload.get("stop_price", None)
 
-    logbot.logs(
-        f"📩 Incoming Order:\n"
-        f"Subaccount: {subaccount}\nStrategy: {strategy}\n"
-        f"{action} {qty_in if qty_in else ''} x {symbol_raw} ({order_type.upper()})"
+    logbot.info(
+        "📩 Incoming Order:\nSubaccount: %s\nStrategy: %s\n%s %s x %s (%s)",
+        subaccount, strategy, action, qty_in if qty_in else '', symbol_raw, order_type.upper(),
     )
 
     # 关键：交易/持仓统一用“无斜杠、USDT->USD”的符号
-    symbol_trade = _norm_trade_symbol(symbol_raw)
+    is_crypto, symbol_trade, _ = _classify(symbol_raw)
+
+    handler = _HANDLERS.get(action)
+    if handler is None:
+        return {"success": False, "message": f"❌ Unknown action: {action}"}
+    qty_fn, side = handler
+
+    # 仅在 BUY 进场时使用 BRACKET；SELL 依旧为平仓，不做空
+    bracket = tp is not None and sl is not None and side == OrderSide.BUY
+    if bracket and order_type != "limit":
+        order_type = "market"
+    spec = _ORDER_TYPES.get(order_type)
+    if spec is None:
+        return {"success": False, "message": f"❌ Unsupported order type: {order_type}"}
+    request_cls, price_field = spec
+    kind = f"{order_type.upper()} BRACKET" if bracket else order_type.upper()
+    price_val = limit_price if price_field == "limit_price" else stop_price
+    if price_field and price_val is None:
+        return {"success": False, "message": f"❌ Missing {price_field} for {kind.lower()} order"}
 
     try:
-        trading_client, stock_client, crypto_client = _get_clients(subaccount)
+        clients = _get_clients(subaccount)
+        trading_client = clients[0]
         # ---------- 方向：BUY / SELL ----------
-        if action == "BUY":
-            # qty 明确则优先，其次 percentage，最后默认 1
-            max_slots = None
-            if max_slots_raw is not None:
-                try:
-                    max_slots_int = int(Decimal(str(max_slots_raw)))
-                    if max_slots_int > 0:
-                        max_slots = max_slots_int
-                    else:
-                        logbot.logs(f"[Order] Ignoring non-positive max_slots={max_slots_raw}")
-                except Exception:
-                    logbot.logs(f"[Order] Invalid max_slots value: {max_slots_raw}")
-
-            if qty_in is not None:
-                qty_dec = Decimal(str(qty_in))
-            elif percentage:
-                price = get_latest_price(symbol_raw, stock_client, crypto_client)
-                if not price:
-                    raise Exception("No price data")
-                buying_power = Decimal(str(trading_client.get_account().cash))
-                qty_dec = (buying_power * Decimal(str(percentage))) / Decimal(str(price))
-            elif max_slots:
-                # ---- max_slots sizing ----
-                account = trading_client.get_account()
-                try:
-                    equity = Decimal(str(account.equity))
-                except Exception:
-                    raise Exception("Failed to load account equity for max_slots sizing")
-
-                buffer_ratio = Decimal("0.05")
-                if buffer_ratio_raw is not None:
-                    try:
-                        buffer_ratio = Decimal(str(buffer_ratio_raw))
-                    except Exception:
-                        logbot.logs(f"[Order] Invalid buffer_ratio value: {buffer_ratio_raw}, defaulting to 0.05")
-                if buffer_ratio < Decimal("0"):
-                    logbot.logs(f"[Order] buffer_ratio < 0 ({buffer_ratio}); clamping to 0")
-                    buffer_ratio = Decimal("0")
-                if buffer_ratio >= Decimal("1"):
-                    logbot.logs(f"[Order] buffer_ratio >= 1 ({buffer_ratio}); clamping to 0.95")
-                    buffer_ratio = Decimal("0.95")
-
-                available_equity = equity * (Decimal("1") - buffer_ratio)
-                if available_equity <= Decimal("0"):
-                    raise Exception("Available equity is non-positive after buffer_ratio adjustment")
-
-                try:
-                    positions = trading_client.get_all_positions()
-                except Exception as pos_err:
-                    raise Exception(f"Failed to fetch open positions: {pos_err}")
-                open_slots = sum(
-                    1 for p in positions
-                    if Decimal(str(getattr(p, "qty", "0"))).copy_abs() > Decimal("0")
-                )
-                if open_slots >= max_slots:
-                    msg = (
-                        f"Skipped BUY for {symbol_trade}: open positions {open_slots} "
-                        f"already at/above max_slots {max_slots}"
-                    )
-                else:
-                    target_value = available_equity / Decimal(str(max_slots))
-                    price = get_latest_price(symbol_raw, stock_client, crypto_client)
-                    if not price:
-                        raise Exception("No price data")
-                    qty_dec = target_value / Decimal(str(price))
-                    if qty_dec <= Decimal("0"):
-                        raise Exception("Calculated quantity is non-positive with max_slots sizing")
-                    logbot.logs(
-                        f"[Order] max_slots sizing -> equity {equity} buffer {buffer_ratio} "
-                        f"target_value {target_value} qty {qty_dec}"
-                    )
-                if open_slots >= max_slots:
-                    logbot.logs(f"[Order] {msg}")
-                    return {"success": True, "message": msg}
-            else:
-                qty_dec = Decimal("1")
-            side = OrderSide.BUY
-
-        elif action == "SELL":
-            # 先查仓（注意必须用规范化后的 symbol_trade，避免 ETH/USD 触发 404）
-            try:
-                pos = trading_client.get_open_position(symbol_trade)
-                pos_qty = Decimal(str(pos.qty))
-            except Exception as ge:
-                raise Exception(f"Not holding {symbol_trade}: {ge}")
-
-            if pos_qty <= Decimal("0"):
-                raise Exception(f"No open position for {symbol_trade}")
-
-            if qty_in is not None:
-                qty_dec = Decimal(str(qty_in))
-            elif percentage:
-                qty_dec = (pos_qty * Decimal(str(percentage)))
-            else:
-                qty_dec = pos_qty
-            side = OrderSide.SELL
-
-            # 卖出前：取消该标的的未成交 SELL 方向挂单（通常为 bracket 子单）以避免冲突/过度对冲
-            try:
-                od_filter = GetOrdersRequest(
-                    status=QueryOrderStatus.OPEN,
-                    symbols=[symbol_trade],
-                    nested=True,
-                )
-                open_orders = trading_client.get_orders(filter=od_filter)
-                canceled_cnt = 0
-                for od in open_orders:
-                    try:
-                        od_side = str(getattr(od, "side", "")).lower()
-                        if od_side == "sell":
-                            trading_client.cancel_order_by_id(od.id)
-                            canceled_cnt += 1
-                    except Exception as ce:
-                        logbot.logs(f"[Order] cancel child sell order failed for {symbol_trade}: {ce}")
-                if canceled_cnt:
-                    logbot.logs(f"[Order] Canceled {canceled_cnt} open SELL orders for {symbol_trade} before SELL")
-            except Exception as e_can:
-                # 非关键路径，失败只记录日志
-                logbot.logs(f"[Order] fetch/cancel open orders failed for {symbol_trade}: {e_can}")
-
-        else:
-            return {"success": False, "message": f"❌ Unknown action: {action}"}
+        qty_dec = qty_fn(payload, symbol_raw, symbol_trade, subaccount, clients)
+        if isinstance(qty_dec, dict):
+            return qty_dec
 
         # ---------- 数量规整 ----------
-        if _is_crypto(symbol_raw):
+        if is_crypto:
             qty_str = _clamp_crypto_qty(qty_dec)
         else:
             # 股票至少 1 股
-            if qty_dec < 1:
-                qty_dec = Decimal("1")
-            qty_str = str(int(qty_dec))
-
-        # ---------- TIF ----------
-        tif_enum = _to_tif_enum(tif)
-
-        # ---------- 构建订单（兼容旧 SDK 的 client_order_id） ----------
-        def _build(kind_local: str, with_id, no_id):
-            try:
-                req = with_id()
-                return kind_local, req
-            except Exception as e:
-                logbot.logs(f"[Order] client_order_id not supported, fallback: {e}")
-                return kind_local, no_id()
-
-        # 仅在 BUY 进场时使用 BRACKET；SELL 依旧为平仓，不做空
-        if (tp is not None and sl is not None) and side == OrderSide.BUY:
-            if order_type == "limit":
-                if limit_price is None:
-                    return {"success": False, "message": "❌ Missing limit_price for limit bracket order"}
-                kind, order_request = _build(
-                    "LIMIT BRACKET",
-                    lambda: LimitOrderRequest(
-                        symbol=symbol_trade,
-                        qty=qty_str,
-                        side=side,
-                        time_in_force=tif_enum,
-                        limit_price=str(limit_price),
-                        client_order_id=client_order_id_in,
-                        order_class=OrderClass.BRACKET,
-                        take_profit=TakeProfitRequest(limit_price=float(tp)),
-                        stop_loss=StopLossRequest(stop_price=float(sl))
-                    ),
-                    lambda: LimitOrderRequest(
-                        symbol=symbol_trade,
-                        qty=qty_str,
-                        side=side,
-                        time_in_force=tif_enum,
-                        limit_price=str(limit_price),
-                        order_class=OrderClass.BRACKET,
-                        take_profit=TakeProfitRequest(limit_price=float(tp)),
-                        stop_loss=StopLossRequest(stop_price=float(sl))
-                    )
-                )
-            else:
-                order_type = "market"
-                kind, order_request = _build(
-                    "MARKET BRACKET",
-                    lambda: MarketOrderRequest(
-                        symbol=symbol_trade,
-                        qty=qty_str,
-                        side=side,
-                        time_in_force=tif_enum,
-                        client_order_id=client_order_id_in,
-                        order_class=OrderClass.BRACKET,
-                        take_profit=TakeProfitRequest(limit_price=float(tp)),
-                        stop_loss=StopLossRequest(stop_price=float(sl))
-                    ),
-                    lambda: MarketOrderRequest(
-                        symbol=symbol_trade,
-                        qty=qty_str,
-                        side=side,
-                        time_in_force=tif_enum,
-                        order_class=OrderClass.BRACKET,
-                        take_profit=TakeProfitRequest(limit_price=float(tp)),
-                        stop_loss=StopLossRequest(stop_price=float(sl))
-                    )
-                )
-        elif order_type == "market":
-            kind, order_request = _build(
-                "MARKET",
-                lambda: MarketOrderRequest(
-                    symbol=symbol_trade,
-                    qty=qty_str,
-                    side=side,
-                    time_in_force=tif_enum,
-                    client_order_id=client_order_id_in
-                ),
-                lambda: MarketOrderRequest(
-                    symbol=symbol_trade,
-                    qty=qty_str,
-                    side=side,
-                    time_in_force=tif_enum,
-                )
-            )
-        elif order_type == "limit":
-            if limit_price is None:
-                return {"success": False, "message": "❌ Missing limit_price for limit order"}
-            kind, order_request = _build(
-                "LIMIT",
-                lambda: LimitOrderRequest(
-                    symbol=symbol_trade,
-                    qty=qty_str,
-                    side=side,
-                    time_in_force=tif_enum,
-                    limit_price=str(limit_price),
-                    client_order_id=client_order_id_in
-                ),
-                lambda: LimitOrderRequest(
-                    symbol=symbol_trade,
-                    qty=qty_str,
-                    side=side,
-                    time_in_force=tif_enum,
-                    limit_price=str(limit_price),
-                )
-            )
-        elif order_type == "stop":
-            if stop_price is None:
-                return {"success": False, "message": "❌ Missing stop_price for stop order"}
-            kind, order_request = _build(
-                "STOP",
-                lambda: StopOrderRequest(
-                    symbol=symbol_trade,
-                    qty=qty_str,
-                    side=side,
-                    time_in_force=tif_enum,
-                    stop_price=str(stop_price),
-                    client_order_id=client_order_id_in
-                ),
-                lambda: StopOrderRequest(
-                    symbol=symbol_trade,
-                    qty=qty_str,
-                    side=side,
-                    time_in_force=tif_enum,
-                    stop_price=str(stop_price),
-                )
-            )
-        else:
-            return {"success": False, "message": f"❌ Unsupported order type: {order_type}"}
+            qty_str = str(max(1, int(qty_dec)))
+
+        # ---------- 构建订单 ----------
+        fields = dict(symbol=symbol_trade, qty=qty_str, side=side, time_in_force=_to_tif_enum(tif))
+        if price_field:
+            fields[price_field] = str(price_val)
+        if bracket:
+            fields.update(_bracket_legs(tp, sl))
+        if client_order_id_in and _SUPPORTS_CLIENT_OID:
+            fields["client_order_id"] = client_order_id_in
+        order_request = request_cls(**fields)
 
         # ---------- 下单 ----------
-        resp = trading_client.submit_order(order_request)
-        logbot.logs(f"✅ Submitted {kind} order: {resp.id} {symbol_trade} x {qty_str}")
+        if _order_executor is not None and _order_slots.acquire(blocking=False):
+            correlation_id = client_order_id_in or uuid.uuid4().hex
+            fut = _order_executor.submit(
+                _submit, trading_client, order_request, subaccount, symbol_trade, kind, qty_str
+            )
+            fut.add_done_callback(lambda f: _on_submitted(f, correlation_id, symbol_trade))
+            return {
+                "success": True,
+                "queued": True,
+                "correlation_id": correlation_id,
+                "message": f"⏳ Queued {kind} order for {qty_str} x {symbol_trade}",
+            }
+        _submit(trading_client, order_request, subaccount, symbol_trade, kind, qty_str)
         return {"success": True, "message": f"✅ Submitted {kind} order for {qty_str} x {symbol_trade}"}
 
     except Exception as e:
         # 尽量把错误打全，包含规范化后的符号，便于定位
-        logbot.logs(f"🚫 Order failed ({symbol_trade}): {type(e).__name__}: {e}", True)
+        logbot.error("🚫 Order failed (%s): %s: %s", symbol_trade, type(e).__name__, e)
         return {"success": False, "message": f"Error: {e}"}
+
+
+# 进程启动即在后台为 env 中声明的所有账户建连（缺少凭证时静默跳过）
+def _prewarm_aliases():
+    for a in _aliases_from_env():
+        try:
+            _get_clients(a)
+        except Exception as e:
+            logbot.info("[Warmup] clients not prewarmed for %s: %s", a, e, log_to_discord=False)
+
+if _PREWARM:
+    _warmup_pool.submit(_prewarm_aliases)
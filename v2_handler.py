@@ -1,9 +1,10 @@
-import os, json, re
+import os, re, threading
 from datetime import datetime, timezone
-from flask import request, jsonify
-from supabase import create_client
-import requests
+import orjson
+from flask import request, Response
 import logbot
+from concurrent.futures import ThreadPoolExecutor
+from config import TTLCache, gate_cache, get_supabase, http_session, _secret_ok
 
 # --- Env & Clients ---
 SUPABASE_URL = os.environ.get("SUPABASE_URL", "")
@@ -12,30 +13,77 @@ if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("SUPABASE_URL and SUPABASE_API_KEY must be set")
 WEBHOOK_PASSPHRASE_V2 = os.environ.get("WEBHOOK_PASSPHRASE_V2", None)
 HEADER_TOKEN_V2 = os.environ.get("WEBHOOK_HEADER_TOKEN_V2", "")
+_PASSPHRASE_V2_B = (WEBHOOK_PASSPHRASE_V2 or "").encode("utf-8")
+_HEADER_TOKEN_V2_B = HEADER_TOKEN_V2.encode("utf-8")
 WORKER_URL = os.environ.get("WORKER_URL", "")
 WORKER_SECRET = os.environ.get("WORKER_SECRET", "")
+# Single-RPC ingest (requires the tv_ingest_v2 function from the README migrations)
+INGEST_RPC = os.environ.get("V2_INGEST_RPC", "0").strip().lower() in ("1", "true", "yes")
+# Optional: run tv_ingest_v2 over a direct Postgres pool instead of PostgREST
+# (e.g. the Supavisor transaction pooler on :6543; needs psycopg2)
+INGEST_PG_URL = os.environ.get("V2_INGEST_PG_URL", "")
+# Optional shared dedup front (SET NX) across processes/instances; needs redis-py
+REDIS_URL = os.environ.get("REDIS_URL", "")
+# Signal + queue insert in one RPC (requires the tv_persist_signal function from the README migrations)
+PERSIST_RPC = os.environ.get("V2_PERSIST_RPC", "0").strip().lower() in ("1", "true", "yes")
 
 if not WEBHOOK_PASSPHRASE_V2 or len(WEBHOOK_PASSPHRASE_V2) < 16:
     raise RuntimeError("WEBHOOK_PASSPHRASE_V2 must be set and >=16 chars")
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("SUPABASE_URL and SUPABASE_API_KEY must be set for v2")
 
-sb = create_client(SUPABASE_URL, SUPABASE_KEY)
+sb = get_supabase()
 
+_pg_pool = None
+if INGEST_RPC and INGEST_PG_URL:
+    try:
+        from psycopg2.pool import ThreadedConnectionPool
+        _pg_pool = ThreadedConnectionPool(0, int(os.environ.get("V2_INGEST_PG_POOL", "10")), INGEST_PG_URL)
+    except ImportError:
+        logbot.info("[v2] psycopg2 not installed; V2_INGEST_PG_URL ignored", log_to_discord=False)
+
+
+def _json(obj) -> Response:
+    """jsonify replacement serialized with orjson."""
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
+
+# TradingView alerts are tiny; werkzeug's get_data() ignores MAX_CONTENT_LENGTH,
+# so both webhooks read the stream themselves and stop one byte past the cap.
+MAX_WEBHOOK_BODY = int(os.environ.get("WEBHOOK_MAX_BODY_BYTES", "8192"))
+
+
+def _read_body_capped():
+    """Request body (at most MAX_WEBHOOK_BODY bytes), or None when it is larger."""
+    if (request.content_length or 0) > MAX_WEBHOOK_BODY:
+        return None
+    body = request.stream.read(MAX_WEBHOOK_BODY + 1)
+    return None if len(body) > MAX_WEBHOOK_BODY else body
+
+
+_REQUIRED_V2_ORDER = ("strategy", "ticker", "timeframe", "action", "bar_time")
+_REQUIRED_V2 = frozenset(_REQUIRED_V2_ORDER)
+
+_MS_THRESHOLD = 100_000_000_000  # >= this is already ms
+_S_THRESHOLD = 1_000_000_000  # >= this is seconds precision
 
-def _dedup_exists(key: str) -> bool:
-    d = sb.table("signals_raw").select("id").eq("dedup_key", key).execute().data
-    return bool(d)
 
 def _coerce_bar_time_ms(raw) -> int:
+    # Common case: TradingView sends int ms
+    if type(raw) is int:
+        if raw >= _MS_THRESHOLD:
+            return raw
+        if raw >= _S_THRESHOLD:
+            return raw * 1000
+        return raw
     if raw is None:
         raise ValueError("bar_time missing")
     # Numeric int/float (seconds or ms)
     if isinstance(raw, (int, float)):
         val = float(raw)
-        if val >= 1e11:  # already ms
+        if val >= _MS_THRESHOLD:  # already ms
             return int(val)
-        if val >= 1e9:  # seconds precision
+        if val >= _S_THRESHOLD:  # seconds precision
             return int(val * 1000)
         return int(val)
     # String handling
@@ -55,10 +103,12 @@ def _coerce_bar_time_ms(raw) -> int:
         raise ValueError(f"invalid ISO bar_time: {raw}") from e
 
 
-def _ms_to_utc_iso(ms) -> str:
-    ms_int = int(ms)
-    dt = datetime.fromtimestamp(ms_int / 1000, tz=timezone.utc)
-    return dt.isoformat()  # e.g. "2025-09-06T23:40:12.345000+00:00"
+_UTC = timezone.utc
+
+
+def _ms_to_utc_iso(ms: int) -> str:
+    # ms is already an int from _coerce_bar_time_ms; / 1000 (not * 0.001) keeps the ms exact
+    return datetime.fromtimestamp(ms / 1000, _UTC).isoformat()  # e.g. "2025-09-06T23:40:12.345000+00:00"
 
 
 def _payload_preview(raw_bytes: bytes, max_len: int = 500) -> str:
@@ -74,64 +124,190 @@ def _payload_preview(raw_bytes: bytes, max_len: int = 500) -> str:
         return txt[:max_len] + "…"
     return txt
 
-def _insert_signal_raw(p: dict, key: str):
-    sb.table("signals_raw").insert({
-        "strategy": p["strategy"],
-        "ticker": p["ticker"],
-        "timeframe": str(p.get("timeframe", "")),
-        "action": p["action"],
-        "price": p.get("price"),
-        "atr": p.get("atr"),
-        "risk_pct": p.get("risk_pct"),
-        "trail_atr_mult": p.get("trail_atr_mult"),
-        "bar_time": _ms_to_utc_iso(p["bar_time"]),
-        "dedup_key": key,
-        "source": "tv-v2",
-        "raw": p,
-    }).execute()
+def _normalize_row(data: dict) -> dict:
+    """Columns shared by signals_raw and order_queue, coerced once per webhook."""
+    return {
+        "strategy": data["strategy"],
+        "ticker": data["ticker"],
+        "timeframe": str(data.get("timeframe", "")),
+        "action": data["action"],
+        "price": data.get("price"),
+        "atr": data.get("atr"),
+        "risk_pct": data.get("risk_pct"),
+        "trail_atr_mult": data.get("trail_atr_mult"),
+        "bar_time": _ms_to_utc_iso(data["bar_time"]),
+        "raw": data,
+    }
+
+
+def _signal_row(row: dict, key: str) -> dict:
+    return {**row, "dedup_key": key, "source": "tv-v2"}
+
+
+def _insert_signal_raw(row: dict, key: str) -> bool:
+    """Insert unless dedup_key exists (unique index); returns False for a duplicate."""
+    d = sb.table("signals_raw").upsert(
+        _signal_row(row, key), on_conflict="dedup_key", ignore_duplicates=True
+    ).execute().data
+    return bool(d)
 
 
 def _account_enabled() -> bool:
-    d = sb.table("account_state").select("trading_enabled").eq("id", 1).execute().data
+    d = gate_cache.get(("acct",))
+    if d is None:
+        d = sb.table("account_state").select("trading_enabled").eq("id", 1).execute().data
+        gate_cache.set(("acct",), d)
     return bool(d and d[0].get("trading_enabled"))
 
 
 def _strategy_active(name: str):
-    d = sb.table("strategies").select("name,status").eq("name", name).execute().data
+    d = gate_cache.get(("strategy", name))
+    if d is None:
+        d = sb.table("strategies").select("name,status").eq("name", name).execute().data
+        gate_cache.set(("strategy", name), d)
     if not d:
         return False, None
     return d[0].get("status") == "active", d[0]
 
 
-def _enqueue_order(data: dict) -> str:
-    resp = sb.table("order_queue").insert({
+def _order_row(row: dict) -> dict:
+    data = row["raw"]
+    return {
         "status": "ready",
         "reason": None,
-        "strategy": data["strategy"],
-        "ticker": data["ticker"],
-        "timeframe": str(data.get("timeframe", "")),
-        "action": data["action"],
-        "price": data.get("price"),
-        "atr": data.get("atr"),
-        "risk_pct": data.get("risk_pct"),
-        "trail_atr_mult": data.get("trail_atr_mult"),
-        "bar_time": _ms_to_utc_iso(data["bar_time"]),
+        **row,
         "subaccount": data.get("subaccount", "default"),
         "max_slots": data.get("max_slots"),
         "buffer_ratio": data.get("buffer_ratio"),
-        "raw": data,
-    }).execute()
+    }
+
+
+def _enqueue_order(row: dict) -> str:
+    resp = sb.table("order_queue").insert(_order_row(row)).execute()
     return resp.data[0]["id"]
 
 
+def _ingest_rpc(row: dict, key: str) -> dict:
+    """
+    One round-trip ingest via the tv_ingest_v2 Postgres function (see README):
+    dedup + signals_raw insert + account/strategy gate + order_queue insert.
+    Returns {"status": "dup_ignored"|"trading_disabled"|"strategy_paused"|"queued", "id": ...}.
+    """
+    if _pg_pool is not None:
+        return _ingest_pg(_signal_row(row, key), _order_row(row))
+    res = sb.rpc("tv_ingest_v2", {"p_signal": _signal_row(row, key), "p_order": _order_row(row)}).execute().data
+    if isinstance(res, list):
+        res = res[0] if res else {}
+    return res or {}
+
+
+def _ingest_pg(signal: dict, order: dict) -> dict:
+    conn = _pg_pool.getconn()
+    broken = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "select tv_ingest_v2(%s::jsonb, %s::jsonb)",
+                (orjson.dumps(signal).decode(), orjson.dumps(order).decode()),
+            )
+            res = cur.fetchone()[0]
+        conn.commit()
+        return res or {}
+    except Exception:
+        broken = bool(conn.closed)
+        if not broken:
+            conn.rollback()
+        raise
+    finally:
+        _pg_pool.putconn(conn, close=broken)
+
+
+def _persist_rpc(row: dict, key: str, enqueue: bool) -> dict:
+    """
+    signals_raw insert + (optional) order_queue insert in one statement via the
+    tv_persist_signal Postgres function (see README). Returns {"inserted": bool, "id": qid|None}.
+    """
+    res = sb.rpc("tv_persist_signal", {
+        "p_signal": _signal_row(row, key),
+        "p_order": _order_row(row) if enqueue else None,
+    }).execute().data
+    if isinstance(res, list):
+        res = res[0] if res else {}
+    return res or {}
+
+
+# Recently seen dedup keys: duplicates of a committed signal are dropped before any DB
+# call; copies arriving while the first is still in flight get a retryable 503.
+# The signals_raw unique index stays the source of truth.
+_seen_keys = TTLCache(ttl_sec=float(os.environ.get("V2_DEDUP_TTL_SECONDS", "600")), maxsize=4096)
+_redis = None
+if REDIS_URL:
+    try:
+        import redis
+        _redis = redis.Redis.from_url(REDIS_URL, socket_keepalive=True, socket_timeout=0.5)
+    except ImportError:
+        logbot.info("[v2] redis not installed; REDIS_URL ignored", log_to_discord=False)
+
+
+_INFLIGHT, _DONE = "inflight", "done"
+_INFLIGHT_TTL = 30  # Redis safety net if a process dies mid-ingest
+_seen_lock = threading.Lock()
+
+
+def _dedup_claim(key: str) -> str | None:
+    """
+    Claim a dedup key for ingest. Returns None when the caller owns it, else the
+    state of the existing claim: "done" (already persisted) or "inflight".
+    """
+    with _seen_lock:
+        state = _seen_keys.get(key)
+        if state is not None:
+            return state
+        _seen_keys.set(key, _INFLIGHT)
+    if _redis is None:
+        return None
+    try:
+        if _redis.set(f"dd:{key}", _INFLIGHT, ex=_INFLIGHT_TTL, nx=True):
+            return None
+        state = _redis.get(f"dd:{key}")
+    except Exception:
+        return None  # Redis unavailable: let the DB unique index decide
+    _seen_keys.pop(key)
+    return _DONE if state == _DONE.encode() else _INFLIGHT
+
+
+def _dedup_done(key: str):
+    """Ingest committed: later copies of this key are plain duplicates."""
+    _seen_keys.set(key, _DONE)
+    if _redis is not None:
+        try:
+            _redis.set(f"dd:{key}", _DONE, ex=86400)
+        except Exception:
+            pass
+
+
+def _dedup_release(key: str):
+    """Forget a key whose ingest failed so a TradingView retry can go through."""
+    _seen_keys.pop(key)
+    if _redis is not None:
+        try:
+            _redis.delete(f"dd:{key}")
+        except Exception:
+            pass
+
+
+# Worker kicks are fire-and-forget; keep them off the webhook response path
+_kick_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="kick")
+
+
 def _kick_worker(queue_id: str):
     if not WORKER_URL or not WORKER_SECRET:
         return
     try:
-        requests.post(
+        http_session.post(
             f"{WORKER_URL.rstrip('/')}/worker/kick",
-            json={"id": queue_id},
-            headers={"X-Worker-Token": WORKER_SECRET},
+            data=orjson.dumps({"id": queue_id}),
+            headers={"X-Worker-Token": WORKER_SECRET, "Content-Type": "application/json"},
             timeout=1.5,
         )
     except Exception:
@@ -140,34 +316,37 @@ def _kick_worker(queue_id: str):
 
 
 def tv_webhook_v2():
+    raw = _read_body_capped()
+    if raw is None:
+        logbot.error("[v2] ⚠️ payload too large: %s bytes", request.content_length)
+        return _json({"error": "[v2] payload too large"}), 413
+
     # Validate JSON
     try:
-        data = request.get_json(force=True, silent=False)
-    except Exception:
-        logbot.logs(
-            f"[v2] ⚠️ invalid json payload: { _payload_preview(request.data) }",
-            True,
-        )
-        return jsonify({"error": "[v2] invalid json"}), 400
+        data = orjson.loads(raw)
+        if not isinstance(data, dict):
+            raise ValueError("payload is not a JSON object")
+    except ValueError:
+        if logbot.enabled("error"):
+            logbot.error("[v2] ⚠️ invalid json payload: %s", _payload_preview(raw))
+        return _json({"error": "[v2] invalid json"}), 400
 
     # Passphrase (strict)
-    if not data or data.get("passphrase") != WEBHOOK_PASSPHRASE_V2:
-        return jsonify({"error": "[v2] bad passphrase"}), 401
+    if not _secret_ok(data.get("passphrase"), _PASSPHRASE_V2_B):
+        return _json({"error": "[v2] bad passphrase"}), 401
 
     # Optional header token
     if HEADER_TOKEN_V2:
         header_val = request.headers.get("X-Auth") or request.headers.get("X-Webhook-Token")
-        if header_val != HEADER_TOKEN_V2:
-            return jsonify({"error": "[v2] bad header token"}), 401
+        if not _secret_ok(header_val, _HEADER_TOKEN_V2_B):
+            return _json({"error": "[v2] bad header token"}), 401
 
     # Required fields
-    for k in ("strategy", "ticker", "timeframe", "action", "bar_time"):
-        if k not in data:
-            logbot.logs(
-                f"[v2] ⚠️ missing field '{k}' in payload: { _payload_preview(request.data) }",
-                True,
-            )
-            return jsonify({"error": f"[v2] missing {k}"}), 400
+    if not _REQUIRED_V2.issubset(data):
+        k = next(k for k in _REQUIRED_V2_ORDER if k not in data)
+        if logbot.enabled("error"):
+            logbot.error("[v2] ⚠️ missing field '%s' in payload: %s", k, _payload_preview(raw))
+        return _json({"error": f"[v2] missing {k}"}), 400
 
     # Default subaccount
     if "subaccount" not in data:
@@ -177,38 +356,86 @@ def tv_webhook_v2():
     try:
         data["action"] = str(data["action"]).upper()
     except Exception as act_err:
-        logbot.logs(
-            f"[v2] ⚠️ invalid action value: {act_err}; payload={ _payload_preview(request.data) }",
-            True,
-        )
-        return jsonify({"error": "[v2] invalid action"}), 400
+        if logbot.enabled("error"):
+            logbot.error("[v2] ⚠️ invalid action value: %s; payload=%s", act_err, _payload_preview(raw))
+        return _json({"error": "[v2] invalid action"}), 400
 
     # Normalize bar_time to ms
     try:
         data["bar_time"] = _coerce_bar_time_ms(data["bar_time"])
     except ValueError as bt_err:
-        logbot.logs(
-            f"[v2] ⚠️ invalid bar_time: {bt_err}; payload={ _payload_preview(request.data) }",
-            True,
-        )
-        return jsonify({"error": f"[v2] invalid bar_time: {bt_err}"}), 400
+        if logbot.enabled("error"):
+            logbot.error("[v2] ⚠️ invalid bar_time: %s; payload=%s", bt_err, _payload_preview(raw))
+        return _json({"error": f"[v2] invalid bar_time: {bt_err}"}), 400
+
+    # Normalize row columns once; dedup key from the same values
+    row = _normalize_row(data)
+    dedup_key = "|".join((
+        str(row["strategy"]), str(row["ticker"]), row["timeframe"],
+        str(data["bar_time"]), row["action"],
+    ))
+    claimed = _dedup_claim(dedup_key)
+    if claimed == _DONE:
+        return _json({"status": "[v2] dup_ignored", "dedup_key": dedup_key}), 200
+    if claimed == _INFLIGHT:
+        # First copy still ingesting and may yet fail: ask the sender to retry, don't drop it
+        resp = _json({"status": "[v2] in_progress", "dedup_key": dedup_key})
+        resp.headers["Retry-After"] = "1"
+        return resp, 503
+    try:
+        resp = _route_signal(data, row, dedup_key)
+    except Exception:
+        _dedup_release(dedup_key)
+        raise
+    if resp[1] >= 500:
+        _dedup_release(dedup_key)
+    else:
+        _dedup_done(dedup_key)
+    return resp
+
+
+def _route_signal(data: dict, row: dict, dedup_key: str):
+    if INGEST_RPC:
+        res = _ingest_rpc(row, dedup_key)
+        status = res.get("status")
+        if status == "queued":
+            qid = res.get("id")
+            _kick_pool.submit(_kick_worker, qid)
+            return _json({"status": "[v2] queued", "id": qid}), 202
+        if status == "dup_ignored":
+            return _json({"status": "[v2] dup_ignored", "dedup_key": dedup_key}), 200
+        if status in ("trading_disabled", "strategy_paused"):
+            return _json({"status": f"[v2] {status}"}), 200
+        logbot.error("[v2] ⚠️ unexpected tv_ingest_v2 result: %s", res)
+        return _json({"error": "[v2] ingest failed"}), 500
 
-    # Dedup
-    dedup_key = f"{data['strategy']}|{data['ticker']}|{data['timeframe']}|{data['bar_time']}|{data['action']}"
-    if _dedup_exists(dedup_key):
-        return jsonify({"status": "[v2] dup_ignored", "dedup_key": dedup_key}), 200
+    if PERSIST_RPC:
+        # Gates come from the short TTL cache; both inserts go out in one RPC
+        enabled = _account_enabled()
+        active = enabled and _strategy_active(data["strategy"])[0]
+        res = _persist_rpc(row, dedup_key, enqueue=active)
+        if not res.get("inserted"):
+            return _json({"status": "[v2] dup_ignored", "dedup_key": dedup_key}), 200
+        if not enabled:
+            return _json({"status": "[v2] trading_disabled"}), 200
+        if not active:
+            return _json({"status": "[v2] strategy_paused"}), 200
+        qid = res.get("id")
+        _kick_pool.submit(_kick_worker, qid)
+        return _json({"status": "[v2] queued", "id": qid}), 202
 
-    # Always insert into signals_raw
-    _insert_signal_raw(data, dedup_key)
+    # Always insert into signals_raw; an ignored conflict means duplicate
+    if not _insert_signal_raw(row, dedup_key):
+        return _json({"status": "[v2] dup_ignored", "dedup_key": dedup_key}), 200
 
     # Check global/state
     if not _account_enabled():
-        return jsonify({"status": "[v2] trading_disabled"}), 200
+        return _json({"status": "[v2] trading_disabled"}), 200
     active, _st = _strategy_active(data["strategy"])
     if not active:
-        return jsonify({"status": "[v2] strategy_paused"}), 200
+        return _json({"status": "[v2] strategy_paused"}), 200
 
     # Enqueue for worker (QUEUE mode only; do not place orders here)
-    qid = _enqueue_order(data)
-    _kick_worker(qid)
-    return jsonify({"status": "[v2] queued", "id": qid}), 200
+    qid = _enqueue_order(row)
+    _kick_pool.submit(_kick_worker, qid)
+    return _json({"status": "[v2] queued", "id": qid}), 202
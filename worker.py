@@ -1,17 +1,25 @@
-import os, time, datetime
+import os, time, datetime, select, threading, importlib.util
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from datetime import timezone
 from datetime import time as dtime
-from supabase import create_client
-from orderapi import order
+from orderapi import order, _is_crypto
 import logbot
-from flask import Blueprint, request, jsonify
-import requests
+from flask import Blueprint, request, Response
 from config import (
-    load_account_state,
+    load_account_state_cached,
     update_account_state,
+    bump_high_watermark,
     resolve_alpaca_for_alias,
+    alpaca_headers,
     get_or_set_day_open_equity,
     get_equity_cached,
+    get_supabase,
+    http_session,
+    _TRUE_TOKENS,
+    _FALSE_TOKENS,
+    _secret_ok,
 )
 
 _last_report_key = None  # 全局变量：记录已发送日期
@@ -20,72 +28,218 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_API_KEY")
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("Need SUPABASE_URL and SUPABASE_API_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase = get_supabase()
+
+# Batch-claim queue rows in one RPC (requires claim_pending_orders / claim_ready_orders from the README migrations)
+CLAIM_RPC = os.getenv("WORKER_CLAIM_RPC", "0").strip().lower() in _TRUE_TOKENS
+CLAIM_BATCH = int(os.getenv("WORKER_CLAIM_BATCH", "50"))
+# Retry/DLQ bookkeeping in one transaction (requires fail_order from the README migrations)
+FAIL_RPC = os.getenv("WORKER_FAIL_RPC", "0").strip().lower() in _TRUE_TOKENS
+# Process-lifetime settings, read once instead of per order / per kick
+RISK_GUARD_DISABLED = os.getenv("RISK_GUARD_DISABLED", "0").strip().lower() in _TRUE_TOKENS
+TRADING_MODE = (os.getenv("TRADING_MODE", "paper") or "paper").strip().lower()
+WORKER_SECRET = os.getenv("WORKER_SECRET", "")
+_WORKER_SECRET_B = WORKER_SECRET.encode("utf-8")
+
+# --- Queue wake-ups: LISTEN order_new (optional, needs DATABASE_URL + psycopg2) ---
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+_wake = threading.Event()
+_listening = False
+
+
+_LISTEN_BACKOFF_MAX = 300
+
+
+def _listen_loop(dsn: str):
+    global _listening
+    import psycopg2
+    import psycopg2.extensions
+    delay = 1
+    alerted = False  # one Discord alert per outage; retries after that go to the local log only
+    connected_at = None
+    while True:
+        try:
+            conn = psycopg2.connect(dsn)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute("LISTEN order_new;")
+            logbot.info("[Worker] 👂 listening on order_new", log_to_discord=False)
+            connected_at = time.monotonic()
+            _listening = True
+            while True:
+                if select.select([conn], [], [], 60)[0]:
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        _wake.set()
+        except Exception as e:
+            # Fall back to the regular poll cadence until LISTEN is back
+            _listening = False
+            _wake.set()
+            if connected_at is not None and time.monotonic() - connected_at > 60:
+                # Connection had been healthy: this is a new outage
+                delay, alerted = 1, False
+            connected_at = None
+            if alerted:
+                logbot.info("[Worker] LISTEN still down, retry in %ss: %s", delay, e, log_to_discord=False)
+            else:
+                logbot.error("[Worker] ❌ LISTEN error, reconnecting with backoff: %s", e)
+                alerted = True
+            time.sleep(delay)
+            delay = min(delay * 2, _LISTEN_BACKOFF_MAX)
+
+
+def _start_listener() -> bool:
+    if not DATABASE_URL:
+        return False
+    if importlib.util.find_spec("psycopg2") is None:
+        logbot.info("[Worker] psycopg2 not installed; polling only", log_to_discord=False)
+        return False
+    threading.Thread(target=_listen_loop, args=(DATABASE_URL,), daemon=True, name="order-listen").start()
+    return True
+
+
+def _idle_wait(poll_sec: float):
+    """Sleep until a NOTIFY arrives; with a listener the poll is only a 30s safety net."""
+    _wake.wait(30 if _listening else poll_sec)
+    _wake.clear()
+
+
+# Orders for different symbols are placed concurrently (Alpaca limits per account)
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("ORDER_CONCURRENCY", "8")), thread_name_prefix="worker")
+
+
+def _handle_row(row) -> str:
+    """Execute one webhook_queue row; returns its final status ('processed' | 'error')."""
+    row_id = row["id"]
+    payload = row["data"]
+    if isinstance(payload, dict):
+        action_v1 = (payload.get("action") or "").upper()
+        if action_v1 == "SELL" and "percentage" in payload:
+            payload = dict(payload)
+            payload.pop("percentage", None)
+    logbot.info("[Worker] 🚀 Executing order: %s", payload)
+
+    try:
+        # Step 1: Mark as processing
+        if not CLAIM_RPC:
+            supabase.table("webhook_queue").update({"status": "processing"}).eq("id", row_id).execute()
+
+        # Step 2: Place the order
+        result = order(payload)
+
+        # Step 3: Report the outcome; process() flushes statuses in bulk
+        if isinstance(result, dict) and result.get("success"):
+            logbot.logs("[Worker] ✅ Order placed")
+            return "processed"
+        msg = (result or {}).get("message") if isinstance(result, dict) else None
+        logbot.error("[Worker] ❌ Order failed result; marking error. %s", msg)
+        return "error"
+
+    except Exception as e:
+        logbot.error("[Worker] ❌ Order error: %s", e)
+        return "error"
+
+
+def _handle_rows(rows):
+    return [(row["id"], _handle_row(row)) for row in rows]
+
+
+def _flush_statuses(outcomes) -> bool:
+    """One UPDATE ... WHERE id IN (...) per terminal status instead of one per row; False if any failed."""
+    by_status = {}
+    for row_id, status in outcomes:
+        by_status.setdefault(status, []).append(row_id)
+    ok = True
+    for status, ids in by_status.items():
+        try:
+            supabase.table("webhook_queue").update({"status": status}).in_("id", ids).execute()
+        except Exception as e:
+            logbot.error("[Worker] ❌ Failed to mark %d rows %s: %s", len(ids), status, e)
+            ok = False
+    return ok
+
 
 # --- V1 polling loop (unchanged) ---
 def process():
     try:
-        result = supabase.table("webhook_queue").select("*").eq("status", "pending").execute()
-        pending_orders = result.data
+        if CLAIM_RPC:
+            # Rows come back already marked 'processing' (FOR UPDATE SKIP LOCKED)
+            pending_orders = supabase.rpc("claim_pending_orders", {"batch": CLAIM_BATCH}).execute().data
+        else:
+            result = supabase.table("webhook_queue").select("*").eq("status", "pending").execute()
+            pending_orders = result.data
 
         if not pending_orders:
-            time.sleep(10)
+            _idle_wait(10)
             return
 
+        # Same (subaccount, ticker) stays in queue order; different symbols run concurrently
+        groups = {}
         for row in pending_orders:
-            row_id = row["id"]
             payload = row["data"]
-            if isinstance(payload, dict):
-                action_v1 = (payload.get("action") or "").upper()
-                if action_v1 == "SELL" and "percentage" in payload:
-                    payload = dict(payload)
-                    payload.pop("percentage", None)
-            logbot.logs(f"[Worker] 🚀 Executing order: {payload}")
-
+            gkey = (payload.get("subaccount"), payload.get("ticker")) if isinstance(payload, dict) else row["id"]
+            groups.setdefault(gkey, []).append(row)
+        futures = [EXECUTOR.submit(_handle_rows, rows) for rows in groups.values()]
+        outcomes = []
+        for f in as_completed(futures):
             try:
-                # Step 1: Mark as processing
-                supabase.table("webhook_queue").update({"status": "processing"}).eq("id", row_id).execute()
-
-                # Step 2: Place the order
-                result = order(payload)
-
-                # Step 3: Mark appropriately based on result
-                if isinstance(result, dict) and result.get("success"):
-                    supabase.table("webhook_queue").update({"status": "processed"}).eq("id", row_id).execute()
-                    logbot.logs(f"[Worker] ✅ Order placed and marked processed")
-                else:
-                    msg = (result or {}).get("message") if isinstance(result, dict) else None
-                    logbot.logs(f"[Worker] ❌ Order failed result; marking error. {msg}", True)
-                    supabase.table("webhook_queue").update({"status": "error"}).eq("id", row_id).execute()
-
+                outcomes.extend(f.result())
             except Exception as e:
-                logbot.logs(f"[Worker] ❌ Order error: {e}", True)
-                # Optional: revert to 'pending' or mark as 'error'
-                supabase.table("webhook_queue").update({"status": "error"}).eq("id", row_id).execute()
+                logbot.error("[Worker] ❌ Order batch error: %s", e)
+        if not _flush_statuses(outcomes):
+            # Rows may still read as pending; don't re-run them in a hot loop
+            time.sleep(2)
 
     except Exception as e:
-        logbot.logs(f"[Worker] ❌ Supabase poll error: {e}", True)
+        logbot.error("[Worker] ❌ Supabase poll error: %s", e)
         time.sleep(10)
 
 # --- Helpers for V2 queue ---
 def _now_utc():
     return datetime.datetime.now(tz=timezone.utc)
 
+def _not_yet_due(naa, now: datetime.datetime) -> bool:
+    """True if next_attempt_at (PostgREST timestamptz string) is after now; unparsable counts as due."""
+    if not naa:
+        return False
+    try:
+        # PostgREST emits "+00:00"; only a trailing "Z" needs rewriting for fromisoformat
+        return datetime.datetime.fromisoformat(naa[:-1] + "+00:00" if naa[-1] == "Z" else naa) > now
+    except (TypeError, ValueError):
+        return False
+
 def _normalize_base_url(raw: str) -> str:
     b = (raw or "").strip()
     if b.endswith("/v2"):
         b = b[:-3]
     return b.rstrip("/")
 
+@lru_cache(maxsize=64)
+def _alias_base_url(alias: str) -> str:
+    """Normalized Alpaca base for an alias; env is static, like resolve_alpaca_for_alias."""
+    try:
+        return _normalize_base_url(resolve_alpaca_for_alias(alias)[2])
+    except Exception:
+        return _normalize_base_url(os.getenv("ALPACA_BASE_URL", "https://paper-api.alpaca.markets"))
+
+# payload.after_hours_mode values
+_AH_OPG = frozenset(("opg", "opg_market"))
+_AH_MARKET = frozenset(("allow", "market", "mkt"))
+_AH_ANY = _AH_OPG | _AH_MARKET
+
+_SIDE_SIGN = {"BUY": 1, "SELL": -1}
+
+_RTH_OPEN_SEC = 13 * 3600 + 30 * 60
+_RTH_CLOSE_SEC = 20 * 3600
+
+
 def _is_market_open(ts: datetime.datetime) -> bool:
     # US RTH: Mon–Fri 13:30–20:00 UTC
-    dow = ts.weekday()  # 0=Mon .. 6=Sun
-    if dow > 4:
+    if ts.weekday() > 4:  # 0=Mon .. 6=Sun
         return False
-    t = ts.time()
-    start = datetime.time(13, 30)
-    end = datetime.time(20, 0)
-    return (t >= start) and (t <= end)
+    sec = ts.hour * 3600 + ts.minute * 60 + ts.second
+    return _RTH_OPEN_SEC <= sec <= _RTH_CLOSE_SEC
 
 def _parse_reset_time(cfg: dict) -> datetime.time:
     v = (cfg or {}).get("reset_time_utc") or "00:05:00"
@@ -100,49 +254,65 @@ def _is_after_reset_window(now_utc: datetime.datetime, cfg: dict) -> bool:
 
 def _count_open_positions(alias: str) -> int:
     try:
-        key, sec, base, _paper = resolve_alpaca_for_alias(alias)
-        r = requests.get(
+        base = resolve_alpaca_for_alias(alias)[2]
+        r = http_session.get(
             f"{base}/v2/positions",
-            headers={"APCA-API-KEY-ID": key, "APCA-API-SECRET-KEY": sec},
+            headers=alpaca_headers(alias),
             timeout=5,
         )
         if r.status_code == 404:
             return 0
         r.raise_for_status()
-        arr = r.json() or []
+        arr = orjson.loads(r.content) or []
         return len(arr)
     except Exception as e:
-        logbot.logs(f"[Risk] positions fetch failed for {alias}: {e}", True)
+        logbot.error("[Risk] positions fetch failed for %s: %s", alias, e)
         return 0
 
-def _ensure_day_open_equity(sb, alias: str, cfg: dict, now_utc: datetime.datetime):
+# (alias, d) -> day-open equity; fixed once set, so no need to re-read daily_metrics per order
+_day_open_cache = {}
+
+
+def _ensure_day_open_equity(sb, alias: str, cfg: dict, now_utc: datetime.datetime) -> float | None:
+    """Return today's day-open equity for alias, setting it after the reset window if missing."""
+    dkey = now_utc.strftime("%Y-%m-%d")
+    ck = (alias, dkey)
+    hit = _day_open_cache.get(ck)
+    if hit is not None:
+        return hit
     cur = get_or_set_day_open_equity(sb, alias, now_utc)
     if cur is None and _is_after_reset_window(now_utc, cfg):
         try:
             eq = get_equity_cached(alias)
-            dkey = now_utc.strftime("%Y-%m-%d")
             sb.table("daily_metrics").update({"equity": eq}).eq("d", dkey).eq("alias", alias).execute()
-            logbot.logs(f"[Risk] day_open_equity set for {alias} d={dkey} eq={eq}")
+            logbot.info("[Risk] day_open_equity set for %s d=%s eq=%s", alias, dkey, eq)
+            cur = eq
         except Exception as e:
-            logbot.logs(f"[Risk] set day_open_equity failed: {e}", True)
-
-def risk_guard(sb, alias: str) -> None:
-    if (os.getenv("RISK_GUARD_DISABLED", "0").strip().lower() in ("1", "true", "yes")):
+            logbot.error("[Risk] set day_open_equity failed: %s", e)
+    if cur is None:
+        return None
+    if len(_day_open_cache) > 256:
+        _day_open_cache.clear()
+    _day_open_cache[ck] = float(cur)
+    return float(cur)
+
+def risk_guard(sb, alias: str, now: datetime.datetime | None = None) -> None:
+    if RISK_GUARD_DISABLED:
         return
-    cfg = load_account_state(sb) or {}
+    cfg = load_account_state_cached(sb) or {}
     if not cfg:
         return
     if not cfg.get("trading_enabled", True):
         raise Exception("trading_disabled")
 
-    now = _now_utc()
-    _ensure_day_open_equity(sb, alias, cfg, now)
+    now = now or _now_utc()
+    day_open = _ensure_day_open_equity(sb, alias, cfg, now)
 
     # Equity + HWM
     eq = get_equity_cached(alias)
     hwm = cfg.get("daily_high_watermark") or eq
     if eq > float(hwm or 0):
-        update_account_state(sb, daily_high_watermark=eq)
+        bump_high_watermark(sb, eq)
         hwm = eq
 
     # Daily drawdown breaker
@@ -154,12 +324,6 @@ def risk_guard(sb, alias: str) -> None:
             raise Exception("daily_drawdown_limit_reached")
 
     # Absolute daily loss cap
-    dkey = now.strftime("%Y-%m-%d")
-    try:
-        row = sb.table("daily_metrics").select("equity").eq("d", dkey).eq("alias", alias).execute().data
-        day_open = float(row[0]["equity"]) if row and row[0].get("equity") is not None else None
-    except Exception:
-        day_open = None
     loss_cap = cfg.get("daily_loss_cap_usd")
     if (loss_cap is not None) and (day_open is not None):
         if (float(eq) - float(day_open)) <= -float(loss_cap):
@@ -174,9 +338,11 @@ def risk_guard(sb, alias: str) -> None:
             raise Exception("max_positions_total_reached")
 
 def _safe_float(x, default=None):
+    if x is None:
+        return default
+    if type(x) is float:  # numeric columns arrive as float from PostgREST
+        return x
     try:
-        if x is None:
-            return default
         return float(x)
     except Exception:
         return default
@@ -189,9 +355,9 @@ def _safe_bool(x, default=False):
         return bool(x)
     if isinstance(x, str):
         t = x.strip().lower()
-        if t in ("1", "true", "yes", "y", "on"):
+        if t in _TRUE_TOKENS:
             return True
-        if t in ("0", "false", "no", "n", "off"):
+        if t in _FALSE_TOKENS:
             return False
     return default
 
@@ -199,12 +365,22 @@ def _safe_bool(x, default=False):
 def _safe_str(x, default=""):
     if x is None:
         return default
+    if type(x) is str:
+        return x
     try:
         return str(x)
     except Exception:
         return default
 
-def claim_task(queue_id: str) -> bool:
+def _client_order_id(queue_id: str) -> str:
+    """'q_' + the first 28 hex digits of the queue uuid (same value as the old replace+slice)."""
+    q = queue_id
+    if len(q) == 36 and q[8] == "-":
+        return "q_" + q[:8] + q[9:13] + q[14:18] + q[19:23] + q[24:32]
+    return ("q_" + q.replace("-", ""))[:30]
+
+def _claim_row(queue_id: str):
+    """Atomically flip ready -> processing; returns the claimed row (PostgREST returns it) or None."""
     try:
         res = (
             supabase.table("order_queue")
@@ -214,36 +390,33 @@ def claim_task(queue_id: str) -> bool:
             .execute()
         )
         rows = res.data or []
-        return len(rows) > 0
+        return rows[0] if rows else None
     except Exception as e:
-        logbot.logs(f"[Worker] ❌ claim_task error for {queue_id}: {e}", True)
-        return False
+        logbot.error("[Worker] ❌ claim_task error for %s: %s", queue_id, e)
+        return None
+
+def claim_task(queue_id: str) -> bool:
+    return _claim_row(queue_id) is not None
 
 # --- V2: process single order_queue item by id ---
-def process_one_by_id(queue_id: str):
+def process_one_by_id(queue_id: str, item: dict | None = None):
+    """Process one order_queue row; pass `item` when the row was already claimed (batch RPC)."""
     try:
-        # Try to atomically claim the task
-        if not claim_task(queue_id):
-            return {"success": False, "message": "already_taken"}
-
-        # Load the queued item
-        res = supabase.table("order_queue").select("*").eq("id", queue_id).execute()
-        items = res.data or []
-        if not items:
-            return {"success": False, "message": "not_found"}
+        if item is None:
+            # Try to atomically claim the task; the update returns the claimed row
+            item = _claim_row(queue_id)
+            if item is None:
+                return {"success": False, "message": "already_taken"}
 
-        item = items[0]
         if item.get("status") != "processing":
             return {"success": False, "message": f"invalid_status:{item.get('status')}"}
 
+        now = _now_utc()
         # If next_attempt_at is set in the future, release back to ready
-        naa = item.get("next_attempt_at")
-        if naa:
+        if _not_yet_due(item.get("next_attempt_at"), now):
             try:
-                naa_dt = datetime.datetime.fromisoformat(naa.replace("Z", "+00:00"))
-                if naa_dt > _now_utc():
-                    supabase.table("order_queue").update({"status": "ready"}).eq("id", queue_id).execute()
-                    return {"success": False, "message": "deferred"}
+                supabase.table("order_queue").update({"status": "ready"}).eq("id", queue_id).execute()
+                return {"success": False, "message": "deferred"}
             except Exception:
                 pass
 
@@ -252,40 +425,33 @@ def process_one_by_id(queue_id: str):
         flat_exit = _safe_bool(payload.get("flat_exit"), default=True)
         after_hours_mode = _safe_str(payload.get("after_hours_mode"), default="").strip().lower()
         # Build idempotent client_order_id from queue_id
-        qid_compact = queue_id.replace("-", "")
-        client_order_id = ("q_" + qid_compact)[:30]
+        client_order_id = _client_order_id(queue_id)
 
         # Trading mode + base url guard（基于默认 base；若使用多账户，orderapi 内部会按 alias 取具体账户）
-        trading_mode = (os.getenv("TRADING_MODE", "paper") or "paper").strip().lower()
-        alias_for_mode = item.get("subaccount", "default")
-        try:
-            _k, _s, alias_base, _paper = resolve_alpaca_for_alias(alias_for_mode)
-            base_env = _normalize_base_url(alias_base)
-        except Exception:
-            base_env = _normalize_base_url(os.getenv("ALPACA_BASE_URL", "https://paper-api.alpaca.markets"))
+        trading_mode = TRADING_MODE
+        subaccount = item.get("subaccount", "default")
+        base_env = _alias_base_url(subaccount)
         if trading_mode == "paper" and "paper-api.alpaca.markets" not in base_env:
             raise Exception("mode_mismatch: paper expected")
         if trading_mode == "live" and "paper-api.alpaca.markets" in base_env:
             raise Exception("mode_mismatch: live expected")
 
         # Market hours guard (skip for crypto symbols)
-        def _is_crypto_symbol(raw: str) -> bool:
-            s = (raw or "").strip().upper()
-            return ("/" in s) or s.endswith("USD") or s.endswith("USDT")
-
         ticker_raw = item.get("ticker")
-        market_open_now = _is_market_open(_now_utc())
-        if not _is_crypto_symbol(ticker_raw) and not market_open_now:
-            if after_hours_mode in ("allow", "opg", "market", "mkt", "opg_market"):
-                logbot.logs(
-                    f"[Worker] 🌙 after_hours_mode={after_hours_mode or 'allow'} bypassing market hours for {ticker_raw}"
+        is_crypto = _is_crypto(ticker_raw)
+        market_open_now = _is_market_open(now)
+        if not is_crypto and not market_open_now:
+            if after_hours_mode in _AH_ANY:
+                logbot.info(
+                    "[Worker] 🌙 after_hours_mode=%s bypassing market hours for %s",
+                    after_hours_mode or 'allow', ticker_raw,
                 )
             else:
                 raise Exception("market_closed")
 
         # Risk guard (blocks new entries only; no auto-flatten here)
         try:
-            risk_guard(supabase, item.get("subaccount", "default"))
+            risk_guard(supabase, subaccount, now)
         except Exception as rg:
             supabase.table("order_queue").update({
                 "status": "failed",
@@ -301,15 +467,12 @@ def process_one_by_id(queue_id: str):
         r_mult = _safe_float(item.get("r_multiple_tp"), 2.0)  # 没有就用 2R
 
         tp = sl = None
-        if entry is not None and atr is not None and trail_k is not None:
-            if action == "BUY":
-                sl = entry - atr * trail_k
-                risk = max(entry - sl, 0.01)
-                tp = entry + r_mult * risk
-            elif action == "SELL":
-                sl = entry + atr * trail_k
-                risk = max(sl - entry, 0.01)
-                tp = entry - r_mult * risk
+        sign = _SIDE_SIGN.get(action)
+        if sign is not None and entry is not None and atr is not None and trail_k is not None:
+            # BUY: stop below / target above entry; SELL mirrors it
+            sl = entry - sign * atr * trail_k
+            risk = max(sign * (entry - sl), 0.01)
+            tp = entry + sign * r_mult * risk
 
         # 把 risk_pct 作为资金百分比映射给 orderapi 的 percentage（最小改动）
         pct = _safe_float(item.get("risk_pct"))
@@ -317,24 +480,24 @@ def process_one_by_id(queue_id: str):
             pct = None
         # 组装下单 payload
         payload_out = {
-            "ticker": item.get("ticker"),
+            "ticker": ticker_raw,
             "action": action,
             "strategy": item.get("strategy"),
-            "subaccount": item.get("subaccount", "default"),
+            "subaccount": subaccount,
             "client_order_id": client_order_id,
             "order_type": "market",
             # Use GTC for crypto (Alpaca crypto doesn't support DAY); DAY for equities
-            "time_in_force": ("gtc" if _is_crypto_symbol(item.get("ticker")) else "day"),
+            "time_in_force": ("gtc" if is_crypto else "day"),
         }
-        if after_hours_mode in ("opg", "opg_market") and not _is_crypto_symbol(item.get("ticker")):
+        if after_hours_mode in _AH_OPG and not is_crypto:
             payload_out["time_in_force"] = "opg"
             payload_out["order_type"] = "market"
-        elif after_hours_mode in ("allow", "market", "mkt") and not market_open_now:
+        elif after_hours_mode in _AH_MARKET and not market_open_now:
             payload_out["time_in_force"] = "day"
         if pct is not None:
             payload_out["percentage"] = pct
         if action == "SELL" and flat_exit:
-            logbot.logs(f"[Worker] 🧹 flat_exit=True forcing full unload for {item.get('ticker')}")
+            logbot.info("[Worker] 🧹 flat_exit=True forcing full unload for %s", ticker_raw)
         tp_sl_attached = False
         max_slots_cfg = item.get("max_slots")
         if max_slots_cfg is None:
@@ -352,10 +515,10 @@ def process_one_by_id(queue_id: str):
             payload_out["sl"] = sl
             tp_sl_attached = True
 
-        logbot.logs(
-            f"[Worker] 🚀 v2 processing id={queue_id} clid={client_order_id} "
-            f"{payload_out.get('strategy')} {payload_out.get('ticker')} {payload_out.get('subaccount')} "
-            f"tp/sl={'on' if tp_sl_attached else 'off'}"
+        logbot.info(
+            "[Worker] 🚀 v2 processing id=%s clid=%s %s %s %s tp/sl=%s",
+            queue_id, client_order_id, payload_out.get('strategy'), payload_out.get('ticker'),
+            payload_out.get('subaccount'), 'on' if tp_sl_attached else 'off',
         )
 
         # ---------- Place order ----------
@@ -368,7 +531,7 @@ def process_one_by_id(queue_id: str):
             raise Exception(result.get("message", "order_failed"))
 
     except Exception as e:
-        logbot.logs(f"[Worker] ❌ v2 process_one_by_id error: {e}", True)
+        logbot.error("[Worker] ❌ v2 process_one_by_id error: %s", e)
         # If market closed, mark failed immediately (no retry)
         try:
             msg = str(e)
@@ -378,9 +541,12 @@ def process_one_by_id(queue_id: str):
                     "reason": "market_closed",
                     "last_error": msg
                 }).eq("id", queue_id).execute()
+            elif FAIL_RPC:
+                # Atomic retry_count increment, or DLQ copy + mark failed, in one round-trip
+                supabase.rpc("fail_order", {"p_id": queue_id, "p_msg": msg}).execute()
             else:
-                # Retry with backoff (<=3) else DLQ
-                row = supabase.table("order_queue").select("*").eq("id", queue_id).execute().data[0]
+                # Retry with backoff (<=3) else DLQ; the claimed row already carries retry_count
+                row = item or supabase.table("order_queue").select("*").eq("id", queue_id).execute().data[0]
                 rc = int(row.get("retry_count") or 0) + 1
                 if rc <= 3:
                     supabase.table("order_queue").update({
@@ -398,79 +564,137 @@ def process_one_by_id(queue_id: str):
                         "reason": msg
                     }).eq("id", queue_id).execute()
         except Exception as e2:
-            logbot.logs(f"[Worker] ❌ backoff/DLQ error: {e2}", True)
+            logbot.error("[Worker] ❌ backoff/DLQ error: %s", e2)
         return {"success": False, "message": str(e)}
 
 
+def _process_rows_by_id(pairs):
+    """Run (queue_id, claimed row) pairs one after another; used per (subaccount, ticker) group."""
+    out = []
+    for qid, item in pairs:
+        try:
+            out.append((qid, process_one_by_id(qid, item)))
+        except Exception as e:
+            out.append((qid, {"success": False, "message": str(e)}))
+    return out
+
+
+def process_many_by_ids(queue_ids, items=None) -> dict:
+    """
+    Claim the rows, then run them over EXECUTOR; `items` maps id -> already-claimed row.
+    Same (subaccount, ticker) stays in the given order; different symbols run concurrently.
+    """
+    items = dict(items or {})
+    missing = [qid for qid in queue_ids if qid not in items]
+    if missing:
+        items.update(zip(missing, EXECUTOR.map(_claim_row, missing)))
+    results = {}
+    groups = {}
+    for qid in queue_ids:
+        item = items.get(qid)
+        if item is None:
+            results[qid] = {"success": False, "message": "already_taken"}
+            continue
+        groups.setdefault((item.get("subaccount"), item.get("ticker")), []).append((qid, item))
+    futures = [EXECUTOR.submit(_process_rows_by_id, pairs) for pairs in groups.values()]
+    for f in as_completed(futures):
+        results.update(f.result())
+    return results
+
 # Blueprint to expose /worker/kick
 worker_bp = Blueprint("worker", __name__)
 
+
+def _json(obj) -> Response:
+    """jsonify replacement serialized with orjson; batch results are keyed by caller-supplied ids."""
+    return Response(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), mimetype="application/json")
+
+
 @worker_bp.route("/worker/kick", methods=["POST"])
 def worker_kick():
-    token_required = os.getenv("WORKER_SECRET", "")
-    hdr = request.headers.get("X-Worker-Token", "")
-    if not token_required or hdr != token_required:
-        return jsonify({"success": False, "message": "unauthorized"}), 401
+    if not _secret_ok(request.headers.get("X-Worker-Token", ""), _WORKER_SECRET_B):
+        return _json({"success": False, "message": "unauthorized"}), 401
 
     try:
-        body = request.get_json(force=True)
-        qid = (body or {}).get("id")
+        body = orjson.loads(request.get_data(cache=False)) or {}
+        ids = body.get("ids")
+        if ids and isinstance(ids, list):
+            # Batch kick: serial per (subaccount, ticker), concurrent across symbols; answer once all rows are done
+            results = process_many_by_ids(ids)
+            ok = all(r.get("success") for r in results.values())
+            return _json({"success": ok, "results": results}), 200 if ok else 500
+        qid = body.get("id")
         if not qid:
-            return jsonify({"success": False, "message": "missing id"}), 400
+            return _json({"success": False, "message": "missing id"}), 400
         res = process_one_by_id(qid)
         code = 200 if res.get("success") else 500
-        return jsonify(res), code
+        return _json(res), code
     except Exception as e:
-        return jsonify({"success": False, "message": str(e)}), 500
+        return _json({"success": False, "message": str(e)}), 500
 
 
+# 设定触发时间（收盘后 20:10 UTC）
+_REPORT_AT = dtime(20, 10)
+ENABLE_DAILY_REPORT = os.getenv("ENABLE_DAILY_REPORT", "0").strip().lower() in _TRUE_TOKENS
+# 下次需要检查的 monotonic 时刻；之前的调用直接返回，不做时间/字符串运算
+_next_report_mono = 0.0
+
 def _should_run_daily_report(now_utc):
-    # 设定触发时间（收盘后 20:10 UTC）
-    target = dtime(20, 10)
-    return (now_utc.time() >= target)
+    return (now_utc.time() >= _REPORT_AT)
+
+def _seconds_until_report(now_utc) -> float:
+    target = datetime.datetime.combine(now_utc.date(), _REPORT_AT, tzinfo=timezone.utc)
+    if now_utc >= target:
+        target += datetime.timedelta(days=1)
+    return (target - now_utc).total_seconds()
 
 def _try_run_daily_report_once_per_day():
-    global _last_report_key
+    global _last_report_key, _next_report_mono
+    if time.monotonic() < _next_report_mono:
+        return
     now = datetime.datetime.now(timezone.utc)
     key = now.strftime("%Y-%m-%d")
-    if _last_report_key == key:
+    if _last_report_key == key or not _should_run_daily_report(now):
+        _next_report_mono = time.monotonic() + _seconds_until_report(now)
         return
-    if _should_run_daily_report(now):
-        try:
-            # 直接复用你 scripts/daily_report.py 里的 main()，或提取成可导入函数
-            from daily_report import main as run_report
-            run_report()
-            logbot.logs("[Report] ✅ daily report sent")
-            _last_report_key = key
-        except Exception as e:
-            logbot.logs(f"[Report] ❌ daily report error: {e}", True)
+    try:
+        # 直接复用你 scripts/daily_report.py 里的 main()，或提取成可导入函数
+        from daily_report import main as run_report
+        run_report()
+        logbot.logs("[Report] ✅ daily report sent")
+        _last_report_key = key
+        _next_report_mono = time.monotonic() + _seconds_until_report(now)
+    except Exception as e:
+        logbot.error("[Report] ❌ daily report error: %s", e)
+        _next_report_mono = time.monotonic() + 60
 
 if __name__ == "__main__":
     logbot.logs("[Worker] 🟢 Started polling for orders...")
+    _start_listener()
     while True:
         process()
         # Also pick up ready v2 tasks
         try:
-            res = (
-                supabase.table("order_queue")
-                .select("id,status,next_attempt_at")
-                .eq("status", "ready")
-                .limit(20)
-                .execute()
-            )
-            for row in (res.data or []):
-                naa = row.get("next_attempt_at")
-                if naa:
-                    try:
-                        naa_dt = datetime.datetime.fromisoformat(naa.replace("Z", "+00:00"))
-                        if naa_dt > _now_utc():
-                            continue
-                    except Exception:
-                        pass
-                process_one_by_id(row["id"])
+            if CLAIM_RPC:
+                claimed = supabase.rpc("claim_ready_orders", {"batch": 20}).execute().data or []
+                process_many_by_ids([row["id"] for row in claimed], {row["id"]: row for row in claimed})
+            else:
+                # Only due rows come back, so the 20-row page is never filled with backed-off retries
+                now_iso = _now_utc().strftime("%Y-%m-%dT%H:%M:%SZ")
+                res = (
+                    supabase.table("order_queue")
+                    .select("id")
+                    .eq("status", "ready")
+                    .or_(f"next_attempt_at.is.null,next_attempt_at.lte.{now_iso}")
+                    .limit(20)
+                    .execute()
+                )
+                due_ids = [row["id"] for row in (res.data or [])]
+                process_many_by_ids(due_ids)
         except Exception as e:
-            logbot.logs(f"[Worker] ❌ v2 poll error: {e}", True)
+            logbot.error("[Worker] ❌ v2 poll error: %s", e)
         # 每天只运行一次的报表（可选开关）
-        if (os.getenv("ENABLE_DAILY_REPORT", "0").strip().lower() in ("1", "true", "yes")):
+        if ENABLE_DAILY_REPORT:
             _try_run_daily_report_once_per_day()
-        time.sleep(2)
+        if not _listening:
+            time.sleep(2)